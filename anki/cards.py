@@ -29,12 +29,15 @@ def warn():
 
 class Card(object):
 
-    def __init__(self, col, id=None):
+    def __init__(self, col, id=None, row=None):
         self.col = col
         self.timerStarted = None
         self._qa = None
         self._note = None
-        if id:
+        if row:
+            # already fetched by the caller
+            self._loadRow(row)
+        elif id:
             self.id = id
             self.load()
         else:
@@ -55,6 +58,10 @@ class Card(object):
             self.data = ""
 
     def load(self):
+        self._loadRow(self.col.db.first(
+            "select * from cards where id = ?", self.id))
+
+    def _loadRow(self, row):
         (self.id,
          self.nid,
          self.did,
@@ -72,8 +79,7 @@ class Card(object):
          self.odue,
          self.odid,
          self.flags,
-         self.data) = self.col.db.first(
-             "select * from cards where id = ?", self.id)
+         self.data) = row
         self._qa = None
         self._note = None
 
@@ -108,19 +114,23 @@ insert or replace into cards values
             self.data)
 
     def flushSched(self):
+        self.col.db.execute(
+            """update cards set
+mod=?, usn=?, type=?, queue=?, due=?, ivl=?, factor=?, reps=?,
+lapses=?, left=?, odue=?, odid=?, did=? where id = ?""",
+            *self._schedRow())
+
+    def _schedRow(self):
+        "Bump mod/usn and return the values flushSched() writes."
         self.mod = intTime()
         self.usn = self.col.usn()
         # bug checks
         if self.queue == 2 and self.odue and not self.col.decks.isDyn(self.did):
             warn()
         assert self.due < 4294967296
-        self.col.db.execute(
-            """update cards set
-mod=?, usn=?, type=?, queue=?, due=?, ivl=?, factor=?, reps=?,
-lapses=?, left=?, odue=?, odid=?, did=? where id = ?""",
-            self.mod, self.usn, self.type, self.queue, self.due, self.ivl,
-            self.factor, self.reps, self.lapses,
-            self.left, self.odue, self.odid, self.did, self.id)
+        return (self.mod, self.usn, self.type, self.queue, self.due, self.ivl,
+                self.factor, self.reps, self.lapses,
+                self.left, self.odue, self.odid, self.did, self.id)
 
     def q(self, reload=False, browser=False):
         return self.css() + self._getQA(reload, browser)['q']
@@ -7,7 +7,7 @@ from anki.lang import _, ngettext
 from anki.utils import ids2str, hexifyID, checksum, fieldChecksum, stripHTML, \
     intTime, splitFields, joinFields, maxID, json
 from anki.hooks import runHook, runFilter
-from anki.sched import Scheduler
+from anki.sched import Scheduler, addTempTables
 from anki.models import ModelManager
 from anki.media import MediaManager
 from anki.decks import DeckManager
@@ -28,6 +28,7 @@ defaultConf = {
     'timeLim': 0,
     'estTimes': True,
     'dueCounts': True,
+    'interleaveDecks': False,
     # other config
     'curModel': None,
     'nextPos': 1,
@@ -41,10 +42,15 @@ class _Collection(object):
 
     def __init__(self, db, server=False):
         self.db = db
+        anki.find.addFunctions(db)
+        addTempTables(db)
         self.path = db._path
         self.server = server
         self._lastSave = time.time()
+        self._textIndex = None
+        self._dupeIndex = None
         self.clearUndo()
+        self.finder = anki.find.Finder(self)
         self.media = MediaManager(self, server)
         self.models = ModelManager(self)
         self.decks = DeckManager(self)
@@ -147,12 +153,16 @@ crt=?, mod=?, scm=?, dty=?, usn=?, ls=?, conf=?""",
         import anki.db
         if not self.db:
             self.db = anki.db.DB(self.path)
+            anki.find.addFunctions(self.db)
+            addTempTables(self.db)
             self.media.connect()
 
     def rollback(self):
         self.db.rollback()
         self.load()
         self.lock()
+        # rolled back changes don't show up in the db's change count
+        self.sched._dueCounts = None
 
     def modSchema(self, check=True):
         "Mark schema modified. Call this first so user can abort if necessary."
@@ -187,6 +197,9 @@ crt=?, mod=?, scm=?, dty=?, usn=?, ls=?, conf=?""",
         self.models.beforeUpload()
         self.tags.beforeUpload()
         self.decks.beforeUpload()
+        # the text and duplicate indices are local only
+        self.disableTextIndex()
+        self.disableDupeIndex()
         self.modSchema()
         self.ls = self.scm
         self.close()
@@ -260,6 +273,12 @@ crt=?, mod=?, scm=?, dty=?, usn=?, ls=?, conf=?""",
         # more card templates
         self._logRem(ids, REM_NOTE)
         self.db.execute("delete from notes where id in %s" % strids)
+        if self.hasTextIndex():
+            self.db.execute("delete from notes_fts where rowid in "+strids)
+        if self.tags.hasIndex():
+            self.db.execute("delete from note_tags where nid in "+strids)
+        if self.hasDupeIndex():
+            self.db.execute("delete from field_sums where nid in "+strids)
 
     # Card creation
     ##########################################################################
@@ -400,16 +419,17 @@ insert into cards values (?,?,?,?,?,?,0,0,?,0,0,0,0,0,0,0,0,"")""",
             return
         sids = ids2str(ids)
         nids = self.db.list("select nid from cards where id in "+sids)
+        old = self.sched._preCardChange(ids)
         # remove cards
         self._logRem(ids, REM_CARD)
         self.db.execute("delete from cards where id in "+sids)
         # then notes
-        if not notes:
-            return
-        nids = self.db.list("""
+        if notes:
+            nids = self.db.list("""
 select id from notes where id in %s and id not in (select nid from cards)""" %
-                     ids2str(nids))
-        self._remNotes(nids)
+                         ids2str(nids))
+            self._remNotes(nids)
+        self.sched._postCardChange(old, ids)
 
     def emptyCids(self):
         rem = []
@@ -445,6 +465,98 @@ where c.nid = n.id and c.id in %s group by nid""" % ids2str(cids)):
                       nid))
         # apply, relying on calling code to bump usn+mod
         self.db.executemany("update notes set sfld=?, csum=? where id=?", r)
+        self._updateTextIndex(snids)
+        self._updateDupeIndex(snids)
+
+    # Text index
+    ##########################################################################
+    # An optional fts5 table holding the same text as notes.flds and
+    # notes.sfld, which the finder uses to narrow down text searches. It's
+    # only kept locally, so it's dropped before a full upload.
+
+    def enableTextIndex(self):
+        "Create the text index. False if sqlite lacks fts5 support."
+        if self.hasTextIndex():
+            return True
+        self.finder.clearCache()
+        try:
+            self.db.execute("""
+create virtual table notes_fts using fts5(flds, sfld, tokenize='trigram')""")
+        except Exception:
+            return False
+        self.db.execute("""
+insert into notes_fts (rowid, flds, sfld) select id, flds, sfld from notes""")
+        # an index rolled back to empty would hide matches
+        self.db.commit()
+        self._textIndex = True
+        return True
+
+    def disableTextIndex(self):
+        if self.hasTextIndex():
+            self.db.execute("drop table notes_fts")
+        self._textIndex = False
+
+    def hasTextIndex(self):
+        if self._textIndex is None:
+            self._textIndex = bool(self.db.scalar(
+                "select 1 from sqlite_master where name = 'notes_fts'"))
+        return self._textIndex
+
+    def _updateTextIndex(self, snids):
+        if not self.hasTextIndex():
+            return
+        self.db.execute("delete from notes_fts where rowid in "+snids)
+        self.db.execute("""
+insert into notes_fts (rowid, flds, sfld)
+select id, flds, sfld from notes where id in """+snids)
+
+    # Duplicate index
+    ##########################################################################
+    # An optional field_sums table with a checksum of every non-empty field,
+    # so duplicates can be found with a grouped query. Like the text index,
+    # it's local only.
+
+    def enableDupeIndex(self):
+        if self.hasDupeIndex():
+            return
+        self.db.execute("""
+create table field_sums (nid integer not null, mid integer not null,
+ord integer not null, csum integer not null, primary key (nid, ord))""")
+        self.db.execute("""
+create index ix_field_sums_csum on field_sums (mid, ord, csum)""")
+        self._dupeIndex = True
+        self._updateDupeIndex()
+        # an index rolled back to empty would hide duplicates
+        self.db.commit()
+
+    def disableDupeIndex(self):
+        if self.hasDupeIndex():
+            self.db.execute("drop table field_sums")
+        self._dupeIndex = False
+
+    def hasDupeIndex(self):
+        if self._dupeIndex is None:
+            self._dupeIndex = bool(self.db.scalar(
+                "select 1 from sqlite_master where name = 'field_sums'"))
+        return self._dupeIndex
+
+    def _updateDupeIndex(self, snids=None):
+        if not self.hasDupeIndex():
+            return
+        if snids is None:
+            lim = ""
+            self.db.execute("delete from field_sums")
+        else:
+            lim = " where id in " + snids
+            self.db.execute("delete from field_sums where nid in "+snids)
+        def rows():
+            for nid, mid, flds in self.db.execute(
+                "select id, mid, flds from notes"+lim).fetchall():
+                for ord, val in enumerate(splitFields(flds)):
+                    if val:
+                        yield nid, mid, ord, fieldChecksum(val)
+        self.db.executemany(
+            "insert into field_sums values (?,?,?,?)", rows())
 
     # Q/A generation
     ##########################################################################
@@ -517,17 +629,17 @@ where c.nid == f.id
     # Finding cards
     ##########################################################################
 
-    def findCards(self, query, order=False):
-        return anki.find.Finder(self).findCards(query, order)
+    def findCards(self, query, order=False, limit=None, offset=0):
+        return self.finder.findCards(query, order, limit, offset)
 
-    def findNotes(self, query):
-        return anki.find.Finder(self).findNotes(query)
+    def findNotes(self, query, limit=None, offset=0):
+        return self.finder.findNotes(query, limit, offset)
 
     def findReplace(self, nids, src, dst, regex=None, field=None, fold=True):
         return anki.find.findReplace(self, nids, src, dst, regex, field, fold)
 
-    def findDupes(self, fieldName, search=""):
-        return anki.find.findDupes(self, fieldName, search)
+    def findDupes(self, fieldName, search="", nids=None):
+        return anki.find.findDupes(self, fieldName, search, nids)
 
     # Stats
     ##########################################################################
@@ -656,6 +768,10 @@ select id from notes where id not in (select distinct nid from cards)""")
         return ("\n".join(problems), ok)
 
     def optimize(self):
+        if self.finder.instrument:
+            # adjust the optional indices to the recorded searches
+            from anki.storage import updateAdvisedIndices
+            updateAdvisedIndices(self)
         self.db.execute("vacuum")
         self.db.execute("analyze")
         self.lock()
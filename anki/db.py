@@ -90,6 +90,9 @@ class DB(object):
     def set_progress_handler(self, *args):
         self._db.set_progress_handler(*args)
 
+    def create_function(self, *args):
+        self._db.create_function(*args)
+
     def __enter__(self):
         self._db.execute("begin")
         return self
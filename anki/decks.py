@@ -90,6 +90,7 @@ class DeckManager(object):
         self.decks = json.loads(decks)
         self.dconf = json.loads(dconf)
         self.changed = False
+        self._treeChanged()
 
     def save(self, g=None):
         "Can be called with either a deck or a deck configuration."
@@ -111,9 +112,9 @@ class DeckManager(object):
     def id(self, name, create=True, type=defaultDeck):
         "Add a deck with NAME. Reuse deck if already exists. Return id as int."
         name = name.replace("'", "").replace('"', '')
-        for id, g in self.decks.items():
-            if g['name'].lower() == name.lower():
-                return int(id)
+        id = self._index()['names'].get(name.lower())
+        if id:
+            return int(id)
         if not create:
             return None
         g = copy.deepcopy(type)
@@ -127,6 +128,7 @@ class DeckManager(object):
                 break
         g['id'] = id
         self.decks[str(id)] = g
+        self._treeChanged()
         self.save(g)
         self.maybeAddToActive()
         runHook("newDeck")
@@ -163,6 +165,7 @@ class DeckManager(object):
                 self.col.remCards(cids)
         # delete the deck and add a grave
         del self.decks[str(did)]
+        self._treeChanged()
         # ensure we have an active deck
         if did in self.active():
             self.select(int(self.decks.keys()[0]))
@@ -201,6 +204,7 @@ class DeckManager(object):
     def update(self, g):
         "Add or update an existing deck. Used for syncing and merging."
         self.decks[str(g['id'])] = g
+        self._treeChanged()
         self.maybeAddToActive()
         # mark registry changed, but don't bump mod time
         self.save()
@@ -218,6 +222,7 @@ class DeckManager(object):
                 self.save(grp)
         # adjust name and save
         g['name'] = newName
+        self._treeChanged()
         self.save(g)
         # ensure we have parents
         newName = self._ensureParents(newName)
@@ -414,16 +419,22 @@ class DeckManager(object):
 
     def children(self, did):
         "All children of did, as (name, id)."
-        name = self.get(did)['name']
-        actv = []
-        for g in self.all():
-            if g['name'].startswith(name + "::"):
-                actv.append((g['name'], g['id']))
-        return actv
+        deck = self.get(did)
+        return [(self.get(id)['name'], id)
+                for id in self._index()['children'].get(deck['id'], [])]
 
     def parents(self, did):
         "All parents of did."
-        # get parent and grandparent names
+        deck = self.get(did)
+        parent = self._index()['parent']
+        parents = []
+        pid = parent.get(deck['id'])
+        while pid:
+            parents.insert(0, self.get(pid))
+            pid = parent.get(pid)
+        if len(parents) == deck['name'].count("::"):
+            return parents
+        # a parent is missing; get parent and grandparent names
         parents = []
         for part in self.get(did)['name'].split("::")[:-1]:
             if not parents:
@@ -435,6 +446,35 @@ class DeckManager(object):
             parents[c] = self.get(self.id(p))
         return parents
 
+    # Deck tree index
+    #############################################################
+    # lowercase name -> id, id -> parent id, and id -> ids of all children;
+    # built on demand and dropped when decks are added, renamed or removed
+
+    def _treeChanged(self):
+        self._tree = None
+        # searches embed deck ids
+        self.col.finder.clearCache()
+
+    def _index(self):
+        if self._tree is None:
+            names = {}
+            exact = {}
+            for g in self.decks.values():
+                names[g['name'].lower()] = g['id']
+                exact[g['name']] = g['id']
+            parent = {}
+            children = {}
+            for g in self.decks.values():
+                path = self._path(g['name'])
+                parent[g['id']] = names.get("::".join(path[:-1]).lower())
+                for i in range(1, len(path)):
+                    pid = exact.get("::".join(path[:i]))
+                    if pid:
+                        children.setdefault(pid, []).append(g['id'])
+            self._tree = dict(names=names, parent=parent, children=children)
+        return self._tree
+
     # Sync handling
     ##########################################################################
 
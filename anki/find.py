@@ -2,9 +2,11 @@
 # Copyright: Damien Elmes <anki@ichi2.net>
 # License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
 
-import re
+import re, time
+from collections import OrderedDict, deque
 from anki.utils import ids2str, splitFields, joinFields, stripHTML, intTime
 from anki.consts import *
+from anki.hooks import runHook
 import sre_constants
 
 # Find
@@ -14,40 +16,214 @@ class Finder(object):
 
     def __init__(self, col):
         self.col = col
+        self.cacheSize = 100
+        self.clearCache()
+        self.instrument = False
+        self.statsSize = 100
+        self.clearStats()
 
-    def findCards(self, query, order=False):
-        "Return a list of card ids for QUERY."
-        tokens = self._tokenize(query)
-        preds, args = self._where(tokens)
-        if preds is None:
+    def findCards(self, query, order=False, limit=None, offset=0):
+        "Return a list of card ids for QUERY, optionally only a slice."
+        q = self.cardQuery(query, order)
+        if not q:
             return []
-        order, rev = self._order(order)
-        sql = self._query(preds, order)
+        sql, args = self._slice(q, limit, offset)
         try:
-            res = self.col.db.list(sql, *args)
+            res = self._run(query, self.col.db.list, sql, args)
         except:
             # invalid grouping
             return []
-        if rev:
-            res.reverse()
         return res
 
-    def findNotes(self, query):
+    def findNotes(self, query, limit=None, offset=0):
+        q = self._plan(self._compileNotes, query)
+        if not q:
+            return []
+        if limit is not None:
+            # pages need a stable order
+            q = (q[0] + " order by n.id", q[1])
+        sql, args = self._slice(q, limit, offset)
+        try:
+            res = self._run(query, self.col.db.list, sql, args)
+        except:
+            # invalid grouping
+            return []
+        return res
+
+    def iterCards(self, query, order=False, pageSize=1000):
+        """Yield the card ids for QUERY, fetching PAGESIZE at a time.
+Don't modify the collection until the iteration is finished."""
+        q = self.cardQuery(query, order)
+        if not q:
+            return
+        sql, args = q
+        try:
+            cur = self.col.db.execute(sql, *args)
+        except:
+            # invalid grouping
+            return
+        while 1:
+            rows = cur.fetchmany(pageSize)
+            if not rows:
+                break
+            for row in rows:
+                yield row[0]
+
+    def countCards(self, query):
+        "Return the number of cards matching QUERY."
+        q = self._plan(self._compileWhere, query)
+        if not q:
+            return 0
+        preds, args = q
+        try:
+            return self._run(query, self.col.db.scalar,
+                             self._query(preds, "", cols="count()"), args)
+        except:
+            # invalid grouping
+            return 0
+
+    def countNotes(self, query):
+        "Return the number of notes with cards matching QUERY."
+        q = self._plan(self._compileWhere, query)
+        if not q:
+            return 0
+        preds, args = q
+        try:
+            return self._run(query, self.col.db.scalar, """
+select count(distinct n.id) from cards c, notes n where c.nid=n.id and (%s)""" %
+                             (preds or "1"), args)
+        except:
+            # invalid grouping
+            return 0
+
+    def countCardsBatch(self, queries):
+        "Return the card count of each of QUERIES, from a single scan."
+        cols = []
+        args = []
+        for query in queries:
+            q = self._plan(self._compileWhere, query)
+            if not q:
+                cols.append("0")
+                continue
+            preds, pargs = q
+            cols.append("count(case when (%s) then 1 end)" % (preds or "1"))
+            args.extend(pargs)
+        if not cols:
+            return []
+        sql = "select %s from cards c" % ", ".join(cols)
+        if "n." in sql:
+            sql += ", notes n where c.nid=n.id"
+        try:
+            return list(self.col.db.first(sql, *args))
+        except:
+            # one of the queries is bad; count them separately
+            return [self.countCards(q) for q in queries]
+
+    def _slice(self, q, limit, offset):
+        sql, args = q
+        if limit is not None:
+            sql += " limit ? offset ?"
+            args.extend([limit, offset])
+        return sql, args
+
+    def cardQuery(self, query, order=False):
+        "Return (sql, args) selecting card ids, or None if invalid."
+        return self._plan(self._compileCards, query, order)
+
+    def _compileCards(self, query, order):
         tokens = self._tokenize(query)
         preds, args = self._where(tokens)
         if preds is None:
-            return []
+            return None
+        order = self._order(order)
+        return self._query(preds, order), args
+
+    def noteQuery(self, query):
+        "Return (sql, args) selecting note ids, or None if invalid."
+        return self._plan(self._compileNotes, query)
+
+    def _compileWhere(self, query):
+        tokens = self._tokenize(query)
+        preds, args = self._where(tokens)
+        if preds is None:
+            return None
+        return preds, args
+
+    def _compileNotes(self, query):
+        tokens = self._tokenize(query)
+        preds, args = self._where(tokens)
+        if preds is None:
+            return None
         if preds:
             preds = "(" + preds + ")"
         else:
             preds = "1"
         sql = """
 select distinct(n.id) from cards c, notes n where c.nid=n.id and """+preds
-        try:
-            res = self.col.db.list(sql, *args)
-        except:
-            # invalid grouping
-            return []
+        return sql, args
+
+    # Plan cache
+    ######################################################################
+    # Compiled queries are kept in an LRU cache. Besides the query, the key
+    # holds everything else the compiled sql depends on; changes to models,
+    # decks and tags clear the cache.
+
+    def clearCache(self):
+        self._plans = OrderedDict()
+
+    def _plan(self, fn, query, *args):
+        conf = self.col.conf
+        key = (fn.__name__, query, args, conf['sortType'],
+               conf['sortBackwards'], conf['curDeck'], self.col.sched.today,
+               self.col.sched.dayCutoff, self.col.hasTextIndex())
+        if key in self._plans:
+            plan = self._plans.pop(key)
+            self._compileTime = 0.0
+        else:
+            t = time.time()
+            plan = fn(query, *args)
+            self._compileTime = time.time() - t
+        self._plans[key] = plan
+        while len(self._plans) > self.cacheSize:
+            self._plans.popitem(last=False)
+        if plan is None:
+            return None
+        # callers may modify the args
+        return plan[0], list(plan[1])
+
+    # Statistics
+    ######################################################################
+    # When instrument is set, each search records its compile and execution
+    # time, row count and query plan. Plans whose details contain a "SCAN"
+    # without an index are listed under 'scans'.
+
+    def stats(self):
+        "Return a list of the recorded searches, oldest first."
+        return list(self._stats)
+
+    def clearStats(self):
+        self._stats = deque(maxlen=self.statsSize)
+        self._compileTime = 0.0
+
+    def _run(self, query, fn, sql, args):
+        if not self.instrument:
+            return fn(sql, *args)
+        t = time.time()
+        res = fn(sql, *args)
+        elapsed = time.time() - t
+        plan = [r[-1] for r in self.col.db.all(
+            "explain query plan " + sql, *args)]
+        if self._stats.maxlen != self.statsSize:
+            self._stats = deque(self._stats, maxlen=self.statsSize)
+        entry = dict(
+            query=query, sql=sql, args=list(args),
+            compileTime=self._compileTime, execTime=elapsed,
+            rows=len(res) if isinstance(res, list) else 1,
+            plan=plan,
+            scans=[d for d in plan
+                   if d.startswith("SCAN") and "USING" not in d])
+        self._stats.append(entry)
+        runHook("search", entry)
         return res
 
     # Tokenizing
@@ -173,7 +349,7 @@ select distinct(n.id) from cards c, notes n where c.nid=n.id and """+preds
                 elif cmd == "added":
                     add(self._findAdded(val))
                 else:
-                    add(self._findField(cmd, val))
+                    add(self._findField(cmd, val, args))
             # normal text search
             else:
                 add(self._findText(token, args))
@@ -181,12 +357,12 @@ select distinct(n.id) from cards c, notes n where c.nid=n.id and """+preds
             return None, None
         return s['q'], args
 
-    def _query(self, preds, order):
+    def _query(self, preds, order, cols="c.id"):
         # can we skip the note table?
         if "n." not in preds and "n." not in order:
-            sql = "select c.id from cards c where "
+            sql = "select %s from cards c where " % cols
         else:
-            sql = "select c.id from cards c, notes n where c.nid=n.id and "
+            sql = "select %s from cards c, notes n where c.nid=n.id and " % cols
         # combine with preds
         if preds:
             sql += "(" + preds + ")"
@@ -202,10 +378,10 @@ select distinct(n.id) from cards c, notes n where c.nid=n.id and """+preds
 
     def _order(self, order):
         if not order:
-            return "", False
+            return ""
         elif order is not True:
             # custom order string provided
-            return " order by " + order, False
+            return " order by " + order
         # use deck default
         type = self.col.conf['sortType']
         if type.startswith("note"):
@@ -234,7 +410,9 @@ select distinct(n.id) from cards c, notes n where c.nid=n.id and """+preds
                 raise Exception()
         else:
             raise Exception()
-        return " order by " + sort, self.col.conf['sortBackwards']
+        if self.col.conf['sortBackwards']:
+            sort = ", ".join(s + " desc" for s in sort.split(", "))
+        return " order by " + sort
 
     # Commands
     ######################################################################
@@ -243,6 +421,9 @@ select distinct(n.id) from cards c, notes n where c.nid=n.id and """+preds
         if val == "none":
             return 'tags = ""'
         val = val.replace("*", "%")
+        if self.col.tags.hasIndex():
+            args.append(val)
+            return "n.id in (select nid from note_tags where tag like ?)"
         if not val.startswith("%"):
             val = "% " + val
         if not val.endswith("%"):
@@ -325,9 +506,20 @@ select distinct(n.id) from cards c, notes n where c.nid=n.id and """+preds
 
     def _findText(self, val, args):
         val = val.replace("*", "%")
+        sql = "(n.sfld like ? escape '\\' or n.flds like ? escape '\\')"
+        # narrow down with the text index where the term has at least one
+        # run of 3+ literal characters, and check the candidates with like
+        if isinstance(val, str):
+            val = val.decode("utf8")
+        runs = [r for r in re.split("[%_]", val) if len(r) >= 3]
+        if runs and "\\" not in val and self.col.hasTextIndex():
+            args.append(" AND ".join(
+                '"%s"' % r.replace('"', '""') for r in runs))
+            sql = ("(n.id in (select rowid from notes_fts "
+                   "where notes_fts match ?) and %s)" % sql)
         args.append("%"+val+"%")
         args.append("%"+val+"%")
-        return "(n.sfld like ? escape '\\' or n.flds like ? escape '\\')"
+        return sql
 
     def _findNids(self, val):
         if re.search("[^0-9,]", val):
@@ -395,7 +587,7 @@ select distinct(n.id) from cards c, notes n where c.nid=n.id and """+preds
                             m['id'], t['ord']))
         return " or ".join(lims)
 
-    def _findField(self, field, val):
+    def _findField(self, field, val, args):
         field = field.lower()
         val = val.replace("*", "%")
         # find models that have that field
@@ -403,35 +595,60 @@ select distinct(n.id) from cards c, notes n where c.nid=n.id and """+preds
         for m in self.col.models.all():
             for f in m['flds']:
                 if f['name'].lower() == field:
-                    mods[str(m['id'])] = (m, f['ord'])
+                    mods.setdefault(f['ord'], []).append(m['id'])
         if not mods:
             # nothing has that field
             return
-        # gather nids
-        regex = val.replace("_", ".").replace("%", ".*")
-        nids = []
-        for (id,mid,flds) in self.col.db.execute("""
-select id, mid, flds from notes
-where mid in %s and flds like ? escape '\\'""" % (
-                         ids2str(mods.keys())),
-                         "%"+val+"%"):
-            flds = splitFields(flds)
-            ord = mods[str(mid)][1]
-            strg = flds[ord]
-            try:
-                if re.search("(?i)^"+regex+"$", strg):
-                    nids.append(id)
-            except sre_constants.error:
-                return
-        if not nids:
+        regex = "(?i)^"+val.replace("_", ".").replace("%", ".*")+"$"
+        try:
+            re.compile(regex)
+        except sre_constants.error:
             return
-        return "n.id in %s" % ids2str(nids)
+        # like is a cheap first pass, then match the field itself
+        args.append("%"+val+"%")
+        lims = []
+        for ord, mids in sorted(mods.items()):
+            args.append(regex)
+            lims.append("(n.mid in %s and field_at(n.flds, %d) regexp ?)" % (
+                ids2str(mids), ord))
+        return "n.flds like ? escape '\\' and (%s)" % " or ".join(lims)
+
+# SQL functions
+##########################################################################
+
+_regexps = {}
+
+def _regexp(regex, string):
+    if regex not in _regexps:
+        if len(_regexps) > 100:
+            _regexps.clear()
+        _regexps[regex] = re.compile(regex)
+    return string is not None and bool(_regexps[regex].search(string))
+
+def _anyField(flds, regex):
+    for fld in splitFields(flds):
+        if _regexp(regex, fld):
+            return True
+    return False
+
+def _fieldAt(flds, ord):
+    flds = splitFields(flds)
+    if ord < len(flds):
+        return flds[ord]
+
+def addFunctions(db):
+    "Register the functions searches use with DB."
+    db.create_function("field_at", 2, _fieldAt)
+    db.create_function("any_field", 2, _anyField)
+    db.create_function("regexp", 2, _regexp)
 
 # Find and replace
 ##########################################################################
 
-def findReplace(col, nids, src, dst, regex=False, field=None, fold=True):
-    "Find and replace fields in a note."
+def findReplace(col, nids, src, dst, regex=False, field=None, fold=True,
+                batchSize=1000):
+    """Find and replace fields in a note. Notes are processed BATCHSIZE at a
+time, and only those matching SRC are loaded."""
     mmap = {}
     if field:
         for m in col.models.all():
@@ -448,36 +665,49 @@ def findReplace(col, nids, src, dst, regex=False, field=None, fold=True):
     regex = re.compile(src)
     def repl(str):
         return re.sub(regex, dst, str)
-    d = []
-    snids = ids2str(nids)
-    nids = []
-    for nid, mid, flds in col.db.execute(
-        "select id, mid, flds from notes where id in "+snids):
-        origFlds = flds
-        # does it match?
-        sflds = splitFields(flds)
-        if field:
-            try:
+    # only fetch notes with a match in the fields we'll touch
+    if field:
+        lims = []
+        args = []
+        for mid, ord in mmap.items():
+            lims.append("(mid = %s and field_at(flds, %d) regexp ?)" % (
+                mid, ord))
+            args.append(src)
+        lim = "(%s)" % " or ".join(lims)
+    else:
+        lim = "any_field(flds, ?)"
+        args = [src]
+    nids = list(nids)
+    usn = col.usn()
+    mod = intTime()
+    cnt = 0
+    for i in range(0, len(nids), batchSize):
+        batch = nids[i:i+batchSize]
+        d = []
+        for nid, mid, flds in col.db.execute(
+            "select id, mid, flds from notes where id in %s and %s" % (
+                ids2str(batch), lim), *args).fetchall():
+            origFlds = flds
+            sflds = splitFields(flds)
+            if field:
                 ord = mmap[str(mid)]
                 sflds[ord] = repl(sflds[ord])
-            except KeyError:
-                # note doesn't have that field
-                continue
-        else:
-            for c in range(len(sflds)):
-                sflds[c] = repl(sflds[c])
-        flds = joinFields(sflds)
-        if flds != origFlds:
-            nids.append(nid)
-            d.append(dict(nid=nid,flds=flds,u=col.usn(),m=intTime()))
-    if not d:
-        return 0
-    # replace
-    col.db.executemany(
-        "update notes set flds=:flds,mod=:m,usn=:u where id=:nid", d)
-    col.updateFieldCache(nids)
-    col.genCards(nids)
-    return len(d)
+            else:
+                for c in range(len(sflds)):
+                    sflds[c] = repl(sflds[c])
+            flds = joinFields(sflds)
+            if flds != origFlds:
+                d.append(dict(nid=nid,flds=flds,u=usn,m=mod))
+        if d:
+            # replace
+            col.db.executemany(
+                "update notes set flds=:flds,mod=:m,usn=:u where id=:nid", d)
+            changed = [r['nid'] for r in d]
+            col.updateFieldCache(changed)
+            col.genCards(changed)
+            cnt += len(d)
+        runHook("findReplace", min(i+batchSize, len(nids)), len(nids), cnt)
+    return cnt
 
 def fieldNames(col, downcase=True):
     fields = set()
@@ -494,7 +724,11 @@ def fieldNames(col, downcase=True):
 # Find duplicates
 ##########################################################################
 
-def findDupes(col, fieldName, search=""):
+def findDupes(col, fieldName, search="", nids=None):
+    """Return (value, nids) for each duplicated value of FIELDNAME. If NIDS
+is given, only the duplicates involving those notes are returned."""
+    if col.hasDupeIndex():
+        return _findDupesIndexed(col, fieldName, search, nids)
     # limit search to notes with applicable field name
     if search:
         search = "("+search+") "
@@ -521,4 +755,63 @@ def findDupes(col, fieldName, search=""):
         vals[val].append(nid)
         if len(vals[val]) == 2:
             dupes.append((val, vals[val]))
+    if nids is not None:
+        nids = set(nids)
+        dupes = [d for d in dupes if nids.intersection(d[1])]
+    return dupes
+
+def _findDupesIndexed(col, fieldName, search, nids):
+    # the field's position in each model that has it
+    lims = []
+    for m in col.models.all():
+        fmap = col.models.fieldMap(m)
+        if fieldName in fmap:
+            lims.append("(mid = %s and ord = %d)" % (m['id'],
+                                                     fmap[fieldName][0]))
+    if not lims:
+        return []
+    fields = "(%s)" % " or ".join(lims)
+    lim = fields
+    args = []
+    if search:
+        q = col.finder.noteQuery(search)
+        if not q:
+            return []
+        lim += " and nid in (%s)" % q[0]
+        args = q[1]
+    if nids is None:
+        recheck = ""
+    else:
+        # only recheck the values of the given notes
+        recheck = """
+and csum in (select csum from field_sums where %s and nid in %s)""" % (
+            fields, ids2str(nids))
+    sql = """
+select nid, csum from field_sums where %s and csum in
+(select csum from field_sums where %s %s group by csum having count() > 1)
+""" % (lim, lim, recheck)
+    cands = col.db.all(sql, *(args + args))
+    if not cands:
+        return []
+    # checksums can collide, so compare the values themselves
+    fields = {}
+    def ordForMid(mid):
+        if mid not in fields:
+            model = col.models.get(mid)
+            fields[mid] = col.models.fieldMap(model)[fieldName][0]
+        return fields[mid]
+    vals = {}
+    dupes = []
+    for nid, mid, flds in col.db.all(
+        "select id, mid, flds from notes where id in "+ids2str(
+            set(c[0] for c in cands))):
+        val = splitFields(flds)[ordForMid(mid)]
+        if val not in vals:
+            vals[val] = []
+        vals[val].append(nid)
+        if len(vals[val]) == 2:
+            dupes.append((val, vals[val]))
+    if nids is not None:
+        nids = set(nids)
+        dupes = [d for d in dupes if nids.intersection(d[1])]
     return dupes
@@ -98,6 +98,7 @@ class Anki2Importer(Importer):
             add)
         self.dst.updateFieldCache(dirty)
         self.dst.tags.registerNotes(dirty)
+        self.dst.tags.updateIndex(dirty)
 
     # Models
     ######################################################################
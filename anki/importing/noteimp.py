@@ -143,6 +143,7 @@ class NoteImporter(Importer):
         self.addNew(new)
         self.addUpdates(updates)
         self.col.updateFieldCache(self._ids)
+        self.col.tags.updateIndex(self._ids)
         # generate cards
         if self.col.genCards(self._ids):
             self.log.insert(0, _(
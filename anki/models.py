@@ -76,6 +76,7 @@ class ModelManager(object):
         "Load registry from JSON."
         self.changed = False
         self.models = json.loads(json_)
+        self.col.finder.clearCache()
 
     def save(self, m=None, templates=False):
         "Mark M modified if provided, and schedule registry flush."
@@ -86,6 +87,7 @@ class ModelManager(object):
             if templates:
                 self._syncTemplates(m)
         self.changed = True
+        self.col.finder.clearCache()
         runHook("newModel")
 
     def flush(self):
@@ -308,6 +310,10 @@ select id from cards where nid in (select id from notes where mid = ?)""",
                       intTime(), self.col.usn(), id))
         self.col.db.executemany(
             "update notes set flds=?,mod=?,usn=? where id = ?", r)
+        # field ords have changed, so the indexed fields are stale
+        snids = ids2str([x[3] for x in r])
+        self.col._updateTextIndex(snids)
+        self.col._updateDupeIndex(snids)
 
     # Templates
     ##################################################
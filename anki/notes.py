@@ -58,6 +58,9 @@ insert or replace into notes values (?,?,?,?,?,?,?,?,?,?,?)""",
                             self.mod, self.usn, tags,
                             self.joinedFields(), sfld, csum, self.flags,
                             self.data)
+        self.col._updateTextIndex("(%d)" % self.id)
+        self.col._updateDupeIndex("(%d)" % self.id)
+        self.col.tags.updateIndex([self.id])
         self.col.tags.register(self.tags)
         self._postFlush()
 
@@ -5,16 +5,29 @@
 import time, datetime, random, itertools, math
 from operator import itemgetter
 from heapq import *
-#from anki.cards import Card
+from anki.cards import Card
 from anki.utils import ids2str, intTime, fmtTimeSpan
 from anki.lang import _, ngettext
 from anki.consts import *
 from anki.hooks import runHook
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # queue types: 0=new/cram, 1=lrn, 2=rev, 3=day lrn, -1=suspended, -2=buried
 # revlog types: 0=lrn, 1=rev, 2=relrn, 3=cram
 # positive revlog intervals are in days (rev), negative in seconds (lrn)
 
+def addTempTables(db):
+    """Create the scheduler's temporary tables on DB. Python's sqlite module
+commits before DDL, so this is done when the collection is opened rather
+than in the middle of a change."""
+    db.execute("""
+create temp table if not exists dynCards
+(pos integer primary key, id integer unique)""")
+
 class Scheduler(object):
     name = "std"
     def __init__(self, col):
@@ -23,6 +36,11 @@ class Scheduler(object):
         self.reportLimit = 1000
         self.reps = 0
         self._haveQueues = False
+        self._dueCounts = None
+        self._sibDues = {}
+        self._batch = None
+        self._merges = {}
+        self.pageLimit = 10
         self._updateCutoff()
 
     def getCard(self):
@@ -39,6 +57,8 @@ class Scheduler(object):
     def reset(self):
         deck = self.col.decks.current()
         self._updateCutoff()
+        self._checkDueCounts()
+        self._sibDues = {}
         self._resetLrn()
         self._resetRev()
         self._resetNew()
@@ -46,7 +66,9 @@ class Scheduler(object):
 
     def answerCard(self, card, ease):
         assert ease >= 1 and ease <= 4
-        self.col.markReview(card)
+        if self._batch is None:
+            self.col.markReview(card)
+        old = self._preCardChange(card=card)
         card.reps += 1
         wasNew = card.queue == 0
         if wasNew:
@@ -73,10 +95,62 @@ class Scheduler(object):
             self._updateStats(card, 'rev')
         else:
             raise Exception("Invalid queue")
-        self._updateStats(card, 'time', card.timeTaken())
+        self._updateStats(card, 'time', self._timeTaken(card))
         card.mod = intTime()
         card.usn = self.col.usn()
-        card.flushSched()
+        if self._batch is not None:
+            self._batch['cards'].append(card)
+        else:
+            card.flushSched()
+        self._postCardChange(old, card=card)
+        self._updateSiblings(card)
+
+    def answerCards(self, answers):
+        """Answer a list of (card, ease, timeTaken in ms) in bulk.
+Cards, revlog entries and deck stats are written once at the end, and the
+answers are not added to the undo history."""
+        self.col.clearUndo()
+        if not self._haveQueues:
+            # learning cards are pushed onto the queues
+            self.reset()
+        batch = self._batch = dict(cards=[], revlog=[], stats={})
+        try:
+            for card, ease, taken in answers:
+                batch['taken'] = taken
+                self.answerCard(card, ease)
+        except:
+            # nothing was written, but the counts and queues were adjusted
+            self._dueCounts = None
+            self._haveQueues = False
+            raise
+        finally:
+            self._batch = None
+        valid = self._dueCountsValid()
+        self.col.db.executemany("""update cards set
+mod=?, usn=?, type=?, queue=?, due=?, ivl=?, factor=?, reps=?,
+lapses=?, left=?, odue=?, odid=?, did=? where id = ?""",
+                                [c._schedRow() for c in batch['cards']])
+        # allocate unique ids up front rather than retrying on collisions,
+        # ending at the current time where possible
+        ts = max(intTime(1000) - len(batch['revlog']) + 1, (self.col.db.scalar(
+            "select max(id) from revlog") or 0) + 1)
+        self.col.db.executemany(
+            "insert into revlog values (?,?,?,?,?,?,?,?,?)",
+            [[ts+c] + row for c, row in enumerate(batch['revlog'])])
+        # daily stats, saving each deck once
+        decks = {}
+        for (did, key), cnt in batch['stats'].items():
+            g = decks[did] = self._checkDeckDay(self.col.decks.get(did))
+            g[key][1] += cnt
+        for g in decks.values():
+            self.col.decks.save(g)
+        if valid:
+            self._dueStamp = self._dueCountsStamp()
+
+    def _timeTaken(self, card):
+        if self._batch is not None:
+            return min(self._batch['taken'], card.timeLimit())
+        return card.timeTaken()
 
     def counts(self, card=None):
         counts = [self.newCount, self.lrnCount, self.revCount]
@@ -106,6 +180,88 @@ order by due""" % self._deckLimit(),
         ret = [x[1] for x in sorted(daysd.items())]
         return ret
 
+    def simulateForecast(self, days=365, passRates=(0.85, 0.9), seed=0):
+        """Simulate review load over the next DAYS, returning daily counts.
+PASSRATES are the chances of passing a young and mature card."""
+        # (ivl, factor, days until due, deck) of reviews due in the period;
+        # most cards are usually included, so scanning beats the index
+        cur = self.col.db.execute("""
+select ivl, factor, (case when odid then odue else due end) - ?,
+(case when odid then odid else did end) from cards
+where queue = 2 and +did in %s
+and (case when odid then odue else due end) < ?""" % self._deckLimit(),
+            self.today, self.today + days)
+        if numpy:
+            return self._simulateArrays(cur, days, passRates, seed)
+        return self._simulateCards(cur, days, passRates, seed)
+
+    def _simulateOpts(self, did):
+        "(ivl factor, max ivl, lapse multiplier) for DID."
+        conf = self.col.decks.confForDid(did)
+        return (self._ivlWithFactor(conf['rev'], 1),
+                conf['rev']['maxIvl'], conf['lapse']['mult'])
+
+    def _simulateArrays(self, cur, days, passRates, seed):
+        rows = numpy.fromiter(itertools.chain.from_iterable(cur),
+                              numpy.int64).reshape(-1, 4)
+        ivl = rows[:,0].copy()
+        fct = rows[:,1] / 1000.0
+        late = numpy.maximum(0, -rows[:,2])
+        due = numpy.maximum(0, rows[:,2])
+        dids = numpy.unique(rows[:,3])
+        table = numpy.array([self._simulateOpts(int(did)) for did in dids],
+                            dtype=float).reshape(-1, 3)
+        ivlFct, maxIvl, mult = table[numpy.searchsorted(dids, rows[:,3])].T
+        rand = numpy.random.RandomState(seed)
+        counts = [0]*days
+        for day in range(days):
+            sel = numpy.flatnonzero(due == day)
+            counts[day] = len(sel)
+            if not len(sel):
+                continue
+            old = ivl[sel]
+            ok = rand.random_sample(len(sel)) < numpy.where(
+                old >= 21, passRates[1], passRates[0])
+            # passed cards are answered 'good', failed cards lapse
+            good = ((old + late[sel] // 2) * fct[sel] * ivlFct[sel])
+            good = numpy.minimum(numpy.maximum(
+                old + 1, good.astype(numpy.int64)), maxIvl[sel])
+            lapse = (old * mult[sel]).astype(numpy.int64) + 1
+            ivl[sel] = numpy.where(ok, good, lapse)
+            fct[sel] = numpy.where(
+                ok, fct[sel], numpy.maximum(1.3, fct[sel] - 0.2))
+            late[sel] = 0
+            due[sel] = day + ivl[sel]
+        return counts
+
+    def _simulateCards(self, cur, days, passRates, seed):
+        opts = {}
+        # day -> [[ivl, factor, late, opts], ...]
+        buckets = {}
+        for ivl, factor, due, did in cur:
+            if did not in opts:
+                opts[did] = self._simulateOpts(did)
+            buckets.setdefault(max(0, due), []).append(
+                [ivl, factor / 1000.0, max(0, -due), opts[did]])
+        rand = random.Random(seed)
+        counts = [0]*days
+        for day in range(days):
+            cards = buckets.pop(day, [])
+            counts[day] = len(cards)
+            for c in cards:
+                ivl, fct, late, (ivlFct, maxIvl, mult) = c
+                rate = passRates[1] if ivl >= 21 else passRates[0]
+                if rand.random() < rate:
+                    good = int((ivl + late / 2) * fct * ivlFct)
+                    c[0] = int(min(max(ivl + 1, good), maxIvl))
+                else:
+                    c[0] = int(ivl * mult) + 1
+                    c[1] = max(1.3, fct - 0.2)
+                c[2] = 0
+                if day + c[0] < days:
+                    buckets.setdefault(day + c[0], []).append(c)
+        return counts
+
     def countIdx(self, card):
         if card.queue == 3:
             return 1
@@ -137,6 +293,12 @@ order by due""" % self._deckLimit(),
         key = type+"Today"
         for g in ([self.col.decks.get(card.did)] +
                   self.col.decks.parents(card.did)):
+            self._checkDeckDay(g)
+            if self._batch is not None:
+                # applied by answerCards() when the batch is done
+                k = (g['id'], key)
+                self._batch['stats'][k] = self._batch['stats'].get(k, 0) + cnt
+                continue
             # add
             g[key][1] += cnt
             self.col.decks.save(g)
@@ -147,6 +309,7 @@ order by due""" % self._deckLimit(),
         children = [self.col.decks.get(did) for (name, did) in
                     self.col.decks.children(cur['id'])]
         for g in [cur] + parents + children:
+            self._checkDeckDay(g)
             # add
             g['newToday'][1] -= new
             g['revToday'][1] -= rev
@@ -182,6 +345,64 @@ order by due""" % self._deckLimit(),
             tot += cnt
         return tot
 
+    # Due count cache
+    ##########################################################################
+    # (did, queue) -> number of cards available today, for the new, review
+    # and day learning queues. It's built once on reset and then adjusted
+    # by the operations below, so resets after individual changes don't need
+    # to recount every deck. Any other change to the cards table invalidates
+    # it, as we can't tell which cards were touched.
+
+    def _dueCountsStamp(self):
+        return (self.today, id(self.col.db), self.col.db.totalChanges())
+
+    def _checkDueCounts(self):
+        "Rebuild the due count cache if it's missing or out of date."
+        if self._dueCountsValid():
+            return
+        self._dueCounts = {}
+        for did, queue, cnt in self.col.db.execute("""
+select did, queue, count() from cards where queue = 0 or
+(queue in (2,3) and due <= ?) group by did, queue""", self.today):
+            self._dueCounts[(did, queue)] = cnt
+        self._dueStamp = self._dueCountsStamp()
+
+    def _dueCount(self, did, queue):
+        return self._dueCounts.get((did, queue), 0)
+
+    def _adjDueCounts(self, rows, delta):
+        for did, queue, due in rows:
+            if queue == 0 or (queue in (2, 3) and due <= self.today):
+                key = (did, queue)
+                self._dueCounts[key] = self._dueCounts.get(key, 0) + delta
+
+    def _cardStates(self, ids=None, card=None):
+        if card:
+            return [(card.did, card.queue, card.due)]
+        return self.col.db.all(
+            "select did, queue, due from cards where id in "+ids2str(ids))
+
+    def _dueCountsValid(self):
+        return self._dueCounts is not None and (
+            self._dueStamp == self._dueCountsStamp())
+
+    def _preCardChange(self, ids=None, card=None):
+        "Call before modifying cards. Returns their state, if cache valid."
+        if not self._dueCountsValid():
+            return None
+        return self._cardStates(ids, card)
+
+    def _postCardChange(self, old, ids=None, card=None):
+        "Call after modifying cards, with the result of _preCardChange()."
+        if ids is not None:
+            # may have moved siblings around
+            self._sibDues = {}
+        if old is None:
+            return
+        self._adjDueCounts(old, -1)
+        self._adjDueCounts(self._cardStates(ids, card), 1)
+        self._dueStamp = self._dueCountsStamp()
+
     # Deck list
     ##########################################################################
 
@@ -199,26 +420,43 @@ order by due""" % self._deckLimit(),
                 return None
             parts = parts[:-1]
             return "::".join(parts)
+        # gather the raw counts for every deck in a single pass
+        cnts = self._deckDueCounts()
         for deck in decks:
             p = parent(deck['name'])
+            did = deck['id']
             # new
             nlim = self._deckNewLimitSingle(deck)
             if p:
                 nlim = min(nlim, lims[p][0])
-            new = self._newForDeck(deck['id'], nlim)
+            new = min(nlim, self.reportLimit, cnts.get((did, 0), (0, 0))[0])
             # learning
-            lrn = self._lrnForDeck(deck['id'])
+            n, lrn = cnts.get((did, 1), (0, 0))
+            if n > self.reportLimit:
+                # only the first reportLimit cards are counted
+                lrn = self._lrnForDeck(did)
             # reviews
             rlim = self._deckRevLimitSingle(deck)
             if p:
                 rlim = min(rlim, lims[p][1])
-            rev = self._revForDeck(deck['id'], rlim)
+            rev = min(rlim, self.reportLimit, cnts.get((did, 2), (0, 0))[0])
             # save to list
             data.append([deck['name'], deck['id'], rev, lrn, new])
             # add deck as a parent
             lims[deck['name']] = [nlim, rlim]
         return data
 
+    def _deckDueCounts(self):
+        "Return {(did, queue): (count, lrnReps)} for all decks."
+        cnts = {}
+        for did, queue, cnt, left in self.col.db.execute("""
+select did, queue, count(), sum(left/1000) from cards
+where queue = 0 or (queue = 1 and due < ?) or (queue = 2 and due <= ?)
+group by did, queue""", intTime() + self.col.conf['collapseTime'],
+                                                     self.today):
+            cnts[(did, queue)] = (cnt, left or 0)
+        return cnts
+
     def deckDueTree(self):
         return self._groupChildren(self.deckDueList())
 
@@ -271,6 +509,16 @@ order by due""" % self._deckLimit(),
     # Getting the next card
     ##########################################################################
 
+    def _fetchCards(self, lim, *args):
+        return [Card(self.col, row=row) for row in self.col.db.execute(
+            "select * from cards where "+lim, *args)]
+
+    def _cardsForQueue(self, lim, *args):
+        "Fetch full cards matching LIM in one go, so popping needs no query."
+        cards = self._fetchCards(lim, *args)
+        self._loadSiblings([c.nid for c in cards])
+        return cards
+
     def _getCard(self):
         "Return the next due card id, or None."
         # learning card due?
@@ -299,15 +547,14 @@ order by due""" % self._deckLimit(),
     ##########################################################################
 
     def _resetNewCount(self):
-        cntFn = lambda did, lim: self.col.db.scalar("""
-select count() from (select 1 from cards where
-did = ? and queue = 0 limit ?)""", did, lim)
+        cntFn = lambda did, lim: min(lim, self._dueCount(did, 0))
         self.newCount = self._walkingCount(self._deckNewLimitSingle, cntFn)
 
     def _resetNew(self):
         self._resetNewCount()
         self._newDids = self.col.decks.active()[:]
         self._newQueue = []
+        self._merges.pop(0, None)
         self._updateNewCardRatio()
 
     def _fillNew(self):
@@ -315,13 +562,17 @@ did = ? and queue = 0 limit ?)""", did, lim)
             return True
         if not self.newCount:
             return False
+        if self._interleaved():
+            self._newQueue = self._mergedQueue(
+                0, self._newDids, self._deckNewLimitSingle)
+            return bool(self._newQueue)
         while self._newDids:
             did = self._newDids[0]
             lim = min(self.queueLimit, self._deckNewLimit(did))
             if lim:
                 # fill the queue with the current did
-                self._newQueue = self.col.db.all("""
-select id, due from cards where did = ? and queue = 0 limit ?""", did, lim)
+                self._newQueue = self._cardsForQueue("""
+did = ? and queue = 0 order by due, id limit ?""", did, lim)
                 if self._newQueue:
                     self._newQueue.reverse()
                     return True
@@ -331,19 +582,19 @@ select id, due from cards where did = ? and queue = 0 limit ?""", did, lim)
     def _getNewCard(self):
         if not self._fillNew():
             return
-        (id, due) = self._newQueue.pop()
+        card = self._newQueue.pop()
         # move any siblings to the end?
-        conf = self.col.decks.confForDid(self._newDids[0])
+        conf = self.col.decks.confForDid(card.did)
         if conf['dyn'] or conf['new']['separate']:
             n = len(self._newQueue)
-            while self._newQueue and self._newQueue[-1][1] == due:
+            while self._newQueue and self._newQueue[-1].due == card.due:
                 self._newQueue.insert(0, self._newQueue.pop())
                 n -= 1
                 if not n:
                     # we only have one note in the queue; stop rotating
                     break
         self.newCount -= 1
-        return self.col.getCard(id)
+        return card
 
     def _updateNewCardRatio(self):
         if self.col.conf['newSpread'] == NEW_CARDS_DISTRIBUTE:
@@ -395,6 +646,7 @@ select count() from
         if g['dyn']:
             return self.reportLimit
         c = self.col.decks.confForDid(g['id'])
+        self._checkDeckDay(g)
         return max(0, c['new']['perDay'] - g['newToday'][1])
 
     # Learning queues
@@ -408,10 +660,8 @@ did in %s and queue = 1 and due < ? limit %d)""" % (
             self._deckLimit(), self.reportLimit),
             self.dayCutoff) or 0
         # day
-        self.lrnCount += self.col.db.scalar("""
-select count() from cards where did in %s and queue = 3
-and due <= ? limit %d""" % (self._deckLimit(), self.reportLimit),
-                                            self.today)
+        for did in self.col.decks.active():
+            self.lrnCount += self._dueCount(int(did), 3)
 
     def _resetLrn(self):
         self._resetLrnCount()
@@ -453,9 +703,8 @@ limit %d""" % (self._deckLimit(), self.reportLimit), lim=self.dayCutoff)
         while self._lrnDids:
             did = self._lrnDids[0]
             # fill the queue with the current did
-            self._lrnDayQueue = self.col.db.list("""
-select id from cards where
-did = ? and queue = 3 and due <= ? limit ?""",
+            self._lrnDayQueue = self._cardsForQueue("""
+did = ? and queue = 3 and due <= ? order by due, id limit ?""",
                                     did, self.today, self.queueLimit)
             if self._lrnDayQueue:
                 # order
@@ -472,7 +721,7 @@ did = ? and queue = 3 and due <= ? limit ?""",
     def _getLrnDayCard(self):
         if self._fillLrnDay():
             self.lrnCount -= 1
-            return self.col.getCard(self._lrnDayQueue.pop())
+            return self._lrnDayQueue.pop()
 
     def _answerLrnCard(self, card, ease):
         # ease 1=no, 2=yes, 3=remove
@@ -624,11 +873,19 @@ did = ? and queue = 3 and due <= ? limit ?""",
     def _logLrn(self, card, ease, conf, leaving, type, lastLeft):
         lastIvl = -(self._delayForGrade(conf, lastLeft))
         ivl = card.ivl if leaving else -(self._delayForGrade(conf, card.left))
+        self._addRevlog(card, ease, ivl, lastIvl, type)
+
+    def _addRevlog(self, card, ease, ivl, lastIvl, type):
+        row = [card.id, self.col.usn(), ease, ivl, lastIvl, card.factor,
+               self._timeTaken(card), type]
+        if self._batch is not None:
+            # ids are assigned when the batch is written
+            self._batch['revlog'].append(row)
+            return
         def log():
             self.col.db.execute(
                 "insert into revlog values (?,?,?,?,?,?,?,?,?)",
-                int(time.time()*1000), card.id, self.col.usn(), ease,
-                ivl, lastIvl, card.factor, card.timeTaken(), type)
+                int(time.time()*1000), *row)
         try:
             log()
         except:
@@ -674,6 +931,7 @@ select sum(left/1000) from
         if d['dyn']:
             return self.reportLimit
         c = self.col.decks.confForDid(d['id'])
+        self._checkDeckDay(d)
         return max(0, c['rev']['perDay'] - d['revToday'][1])
 
     def _revForDeck(self, did, lim):
@@ -686,11 +944,7 @@ and due <= ? limit ?)""",
             did, self.today, lim)
 
     def _resetRevCount(self):
-        def cntFn(did, lim):
-            return self.col.db.scalar("""
-select count() from (select id from cards where
-did = ? and queue = 2 and due <= ? limit %d)""" % lim,
-                                      did, self.today)
+        cntFn = lambda did, lim: min(lim, self._dueCount(did, 2))
         self.revCount = self._walkingCount(
             self._deckRevLimitSingle, cntFn)
 
@@ -698,21 +952,25 @@ did = ? and queue = 2 and due <= ? limit %d)""" % lim,
         self._resetRevCount()
         self._revQueue = []
         self._revDids = self.col.decks.active()[:]
+        self._merges.pop(2, None)
 
     def _fillRev(self):
         if self._revQueue:
             return True
         if not self.revCount:
             return False
+        if self._interleaved():
+            self._revQueue = self._mergedQueue(
+                2, self._revDids, self._deckRevLimitSingle)
+            return bool(self._revQueue)
         while self._revDids:
             did = self._revDids[0]
             lim = min(self.queueLimit, self._deckRevLimit(did))
             if lim:
                 # fill the queue with the current did
-                self._revQueue = self.col.db.list("""
-select id from cards where
-did = ? and queue = 2 and due <= ? limit ?""",
-                                                  did, self.today, lim)
+                self._revQueue = self._cardsForQueue("""
+did = ? and queue = 2 and due <= ? order by due, id limit ?""",
+                    did, self.today, lim)
                 if self._revQueue:
                     # ordering
                     if self.col.decks.get(did)['dyn']:
@@ -733,7 +991,95 @@ did = ? and queue = 2 and due <= ? limit ?""",
     def _getRevCard(self):
         if self._fillRev():
             self.revCount -= 1
-            return self.col.getCard(self._revQueue.pop())
+            return self._revQueue.pop()
+
+    # Interleaved queues
+    ##########################################################################
+    # When 'interleaveDecks' is on, the new and review queues are filled from
+    # all active decks at once. Each deck contributes a page of cards at a
+    # time, and the pages are merged through a heap, so the number of queries
+    # depends on the pages consumed rather than on the number of decks.
+
+    def _interleaved(self):
+        return self.col.conf.get('interleaveDecks', False)
+
+    def _mergedQueue(self, queue, dids, limFn):
+        "Return up to queueLimit cards for QUEUE, last card shown first."
+        m = self._merges.get(queue)
+        if m is None:
+            r = random.Random()
+            r.seed(self.today)
+            m = self._merges[queue] = dict(
+                heap=[], rand=r, last={}, left={}, done=set())
+            for did in dids:
+                self._mergePage(m, queue, did)
+        # remaining limit of each deck and its parents
+        rem = {}
+        chains = {}
+        cards = []
+        def chain(did):
+            if did not in chains:
+                chains[did] = [g['id'] for g in [self.col.decks.get(did)] +
+                               self.col.decks.parents(did)]
+            return chains[did]
+        while m['heap'] and len(cards) < self.queueLimit:
+            key, id, card = heappop(m['heap'])
+            did = card.did
+            for gid in chain(did):
+                if gid not in rem:
+                    rem[gid] = limFn(self.col.decks.get(gid))
+            full = set(gid for gid in chain(did) if rem[gid] <= 0)
+            if not full:
+                for gid in chain(did):
+                    rem[gid] -= 1
+                cards.append(card)
+                m['left'][did] -= 1
+                full = set(gid for gid in chain(did) if rem[gid] <= 0)
+            if full:
+                # this deck or a parent has hit its limit; stop paging it
+                # and every deck below it
+                m['done'].add(did)
+                keep = []
+                for e in m['heap']:
+                    if full.intersection(chain(e[2].did)):
+                        m['done'].add(e[2].did)
+                    else:
+                        keep.append(e)
+                heapify(keep)
+                m['heap'] = keep
+            elif not m['left'][did]:
+                self._mergePage(m, queue, did)
+        self._loadSiblings([c.nid for c in cards])
+        cards.reverse()
+        return cards
+
+    def _mergePage(self, m, queue, did):
+        "Push the next page of DID onto the merge heap."
+        if did in m['done']:
+            return
+        due, id = m['last'].get(did, (-2**62, 0))
+        if queue == 2:
+            cards = self._fetchCards("""
+did = ? and queue = 2 and due <= ? and (due > ? or (due = ? and id > ?))
+order by due, id limit ?""", did, self.today, due, due, id, self.pageLimit)
+        else:
+            cards = self._fetchCards("""
+did = ? and queue = 0 and (due > ? or (due = ? and id > ?))
+order by due, id limit ?""", did, due, due, id, self.pageLimit)
+        if len(cards) < self.pageLimit:
+            m['done'].add(did)
+        if not cards:
+            return
+        m['last'][did] = (cards[-1].due, cards[-1].id)
+        m['left'][did] = len(cards)
+        if queue == 0 or self.col.decks.get(did)['dyn']:
+            # new cards and dynamic decks are shown in due order
+            keys = [c.due for c in cards]
+        else:
+            # seeded shuffle for regular reviews
+            keys = sorted(m['rand'].random() for c in cards)
+        for key, card in zip(keys, cards):
+            heappush(m['heap'], (key, card.id, card))
 
     # Answering a review card
     ##########################################################################
@@ -799,18 +1145,7 @@ did = ? and queue = 2 and due <= ? limit ?""",
             card.odue = 0
 
     def _logRev(self, card, ease, delay):
-        def log():
-            self.col.db.execute(
-                "insert into revlog values (?,?,?,?,?,?,?,?,?)",
-                int(time.time()*1000), card.id, self.col.usn(), ease,
-                -delay or card.ivl, card.lastIvl, card.factor, card.timeTaken(),
-                1)
-        try:
-            log()
-        except:
-            # duplicate pk; retry in 10ms
-            time.sleep(0.01)
-            log()
+        self._addRevlog(card, ease, -delay or card.ivl, card.lastIvl, 1)
 
     # Interval management
     ##########################################################################
@@ -851,9 +1186,7 @@ did = ? and queue = 2 and due <= ? limit ?""",
         idealDue = self.today + idealIvl
         conf = self._revConf(card)
         # find sibling positions
-        dues = self.col.db.list(
-            "select due from cards where nid = ? and type = 2"
-            " and id != ?", card.nid, card.id)
+        dues = self._siblingDues(card)
         if not dues or idealDue not in dues:
             return idealIvl
         else:
@@ -872,35 +1205,74 @@ did = ? and queue = 2 and due <= ? limit ?""",
                         break
             return idealIvl + fudge
 
+    # Sibling positions
+    ##########################################################################
+    # nid -> {cid: due} of review cards, loaded for the notes in the queues
+    # when they're filled, and kept up to date as cards are answered
+
+    def _loadSiblings(self, nids):
+        nids = [nid for nid in set(nids) if nid not in self._sibDues]
+        if not nids:
+            return
+        for nid in nids:
+            self._sibDues[nid] = {}
+        for nid, id, due in self.col.db.execute(
+            "select nid, id, due from cards where type = 2 and nid in "+
+            ids2str(nids)):
+            self._sibDues[nid][id] = due
+
+    def _siblingDues(self, card):
+        self._loadSiblings([card.nid])
+        return [due for id, due in self._sibDues[card.nid].items()
+                if id != card.id]
+
+    def _updateSiblings(self, card):
+        sibs = self._sibDues.get(card.nid)
+        if sibs is None:
+            return
+        if card.type == 2:
+            sibs[card.id] = card.due
+        else:
+            sibs.pop(card.id, None)
+
     # Dynamic deck handling
     ##########################################################################
 
     def rebuildDyn(self, did=None):
-        "Rebuild a dynamic deck."
+        "Rebuild a dynamic deck. Returns the number of cards moved into it."
+        t = time.time()
         did = did or self.col.decks.selected()
         deck = self.col.decks.get(did)
         assert deck['dyn']
         # move any existing cards back first, then fill
         self.emptyDyn(did)
-        ids = self._fillDyn(deck)
-        if not ids:
+        cnt = self._fillDyn(deck)
+        runHook("rebuildDyn", did, cnt, time.time() - t)
+        if not cnt:
             return
         # and change to our new deck
         self.col.decks.select(did)
-        return ids
+        return cnt
 
     def _fillDyn(self, deck):
         search, limit, order = deck['terms'][0]
         orderlimit = self._dynOrder(order, limit)
         search += " -is:suspended -deck:filtered"
+        q = self.col.finder.cardQuery(search, order=orderlimit)
+        if not q:
+            return 0
+        sql, args = q
+        # record the matching ids in order, without loading them
+        self.col.db.execute("delete from dynCards")
         try:
-            ids = self.col.findCards(search, order=orderlimit)
+            self.col.db.execute("insert into dynCards (id) "+sql, *args)
         except:
-            ids = []
-            return ids
+            return 0
+        cnt = self.col.db.scalar("select count() from dynCards")
         # move the cards over
-        self._moveToDyn(deck['id'], ids)
-        return ids
+        if cnt:
+            self._moveToDyn(deck['id'])
+        return cnt
 
     def emptyDyn(self, did, lim=None):
         if not lim:
@@ -934,24 +1306,23 @@ due = odue, odue = 0, odid = 0, usn = ?, mod = ? where %s""" % lim,
             raise Exception()
         return t + " limit %d" % l
 
-    def _moveToDyn(self, did, ids):
-        deck = self.col.decks.get(did)
-        data = []
-        t = intTime(); u = self.col.usn()
-        for c, id in enumerate(ids):
-            # start at -100000 so that reviews are all due
-            data.append((did, -100000+c, t, u, id))
+    def _moveToDyn(self, did):
+        "Move the cards listed in the dynCards table into DID."
         # due reviews stay in the review queue. careful: can't use
         # "odid or did", as sqlite converts to boolean
         queue = """
 (case when type=2 and (case when odue then odue <= %d else due <= %d end)
  then 2 else 0 end)"""
         queue %= (self.today, self.today)
-        self.col.db.executemany("""
+        # start at -100000 so that reviews are all due
+        self.col.db.execute("""
 update cards set
 odid = (case when odid then odid else did end),
 odue = (case when odue then odue else due end),
-did = ?, queue = %s, due = ?, mod = ?, usn = ? where id = ?""" % queue, data)
+did = ?, queue = %s,
+due = -100001 + (select pos from dynCards d where d.id = cards.id),
+mod = ?, usn = ? where id in (select id from dynCards)""" % queue,
+            did, intTime(), self.col.usn())
 
     def _dynIvlBoost(self, card):
         assert card.odid and card.type == 2
@@ -1060,15 +1431,17 @@ did = ?, queue = %s, due = ?, mod = ?, usn = ? where id = ?""" % queue, data)
         self.today = int((time.time() - self.col.crt) / 86400)
         # end of day cutoff
         self.dayCutoff = self.col.crt + (self.today+1)*86400
-        # update all daily counts, but don't save decks to prevent needless
-        # conflicts. we'll save on card answer instead
-        def update(g):
-            for t in "new", "rev", "lrn", "time":
-                key = t+"Today"
-                if g[key][0] != self.today:
-                    g[key] = [self.today, 0]
-        for deck in self.col.decks.all():
-            update(deck)
+
+    def _checkDeckDay(self, g):
+        "Zero G's daily counts if they're from a previous day. Returns G."
+        # decks are updated when they're used rather than all at once on
+        # reset, and not saved to prevent needless conflicts. we'll save on
+        # card answer instead
+        for t in "new", "rev", "lrn", "time":
+            key = t+"Today"
+            if g[key][0] != self.today:
+                g[key] = [self.today, 0]
+        return g
 
     def _checkDay(self):
         # check if the day has rolled over
@@ -1163,32 +1536,39 @@ your short-term review workload will become."""))
 
     def suspendCards(self, ids):
         "Suspend cards."
+        old = self._preCardChange(ids)
         self.remFromDyn(ids)
         self.removeFailed(ids)
         self.col.db.execute(
             "update cards set queue=-1,mod=?,usn=? where id in "+
             ids2str(ids), intTime(), self.col.usn())
+        self._postCardChange(old, ids)
 
     def unsuspendCards(self, ids):
         "Unsuspend cards."
+        old = self._preCardChange(ids)
         self.col.db.execute(
             "update cards set queue=type,mod=?,usn=? "
             "where queue = -1 and id in "+ ids2str(ids),
             intTime(), self.col.usn())
+        self._postCardChange(old, ids)
 
     def buryNote(self, nid):
         "Bury all cards for note until next session."
         self.col.setDirty()
         cids = self.col.db.list("select id from cards where nid = ?", nid)
+        old = self._preCardChange(cids)
         self.remFromDyn(cids)
         self.removeFailed(cids)
         self.col.db.execute("update cards set queue = -2 where nid = ?", nid)
+        self._postCardChange(old, cids)
 
     # Resetting
     ##########################################################################
 
     def forgetCards(self, ids):
         "Put cards at the end of the new queue."
+        old = self._preCardChange(ids)
         self.col.db.execute(
             "update cards set type=0,queue=0,ivl=0,factor=? where id in "+
             ids2str(ids), 2500)
@@ -1196,9 +1576,11 @@ your short-term review workload will become."""))
             "select max(due) from cards where type=0") or 0
         # takes care of mod + usn
         self.sortCards(ids, start=pmax+1)
+        self._postCardChange(old, ids)
 
     def reschedCards(self, ids, imin, imax):
         "Put cards in review queue with a new interval in days (min, max)."
+        old = self._preCardChange(ids)
         d = []
         t = self.today
         mod = intTime()
@@ -1210,6 +1592,7 @@ your short-term review workload will become."""))
 update cards set type=2,queue=2,ivl=:ivl,due=:due,
 usn=:usn, mod=:mod, factor=:fact where id=:id and odid=0""",
                                 d)
+        self._postCardChange(old, ids)
 
     # Repositioning new cards
     ##########################################################################
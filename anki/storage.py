@@ -316,3 +316,83 @@ create index if not exists ix_revlog_cid on revlog (cid);
 -- field uniqueness
 create index if not exists ix_notes_csum on notes (csum);
 """)
+
+# Index advisor
+######################################################################
+# Optional indices, each with a pattern matching the queries that could use
+# it. They're created when the recorded workload matches, and dropped again
+# when none of its query plans use them. Indices outside this list are never
+# touched.
+
+_optionalIndices = (
+    # searching by note type or card template
+    ("ix_notes_mid", "notes (mid)", r"\bn\.mid\b"),
+    # filtered decks
+    ("ix_cards_odid", "cards (odid)", r"\bodid\b"),
+    # interval searches; it mustn't lead with did and queue, or it would
+    # compete with ix_cards_sched
+    ("ix_cards_ivl", "cards (ivl)", r"\bivl\s*(<|>|=|!=|between\b)"),
+    # review history by type and time
+    ("ix_revlog_type", "revlog (type, id)", r"\brevlog\b[\s\S]*\btype\b"),
+)
+
+def _indexNames(db):
+    return set(db.list("select name from sqlite_master where type = 'index'"))
+
+def _workload(col, workload):
+    if workload is None:
+        workload = [(s['sql'], s['args']) for s in col.finder.stats()]
+    return workload
+
+def adviseIndices(col, workload=None):
+    """Return (name, hits) for each missing optional index that queries in
+WORKLOAD could use. WORKLOAD is a list of (sql, args), and defaults to the
+searches recorded by the finder."""
+    have = _indexNames(col.db)
+    advice = []
+    for name, cols, pat in _optionalIndices:
+        if name in have:
+            continue
+        hits = len([sql for sql, args in _workload(col, workload)
+                    if re.search(pat, sql)])
+        if hits:
+            advice.append((name, hits))
+    return advice
+
+def indexSizes(db):
+    "Return the on-disk size of each optional index, if SQLite can tell."
+    names = [i[0] for i in _optionalIndices]
+    try:
+        return dict(db.all("""
+select name, sum(pgsize) from dbstat where name in (%s) group by name""" %
+                           ",".join("'%s'" % n for n in names)))
+    except:
+        # dbstat not compiled in
+        return {}
+
+def updateAdvisedIndices(col, workload=None):
+    """Create the advised indices, then drop any optional index that no query
+in WORKLOAD uses. Returns the remaining indices' sizes."""
+    workload = _workload(col, workload)
+    if not workload:
+        return indexSizes(col.db)
+    advised = dict(adviseIndices(col, workload))
+    for name, cols, pat in _optionalIndices:
+        if name in advised:
+            col.db.execute("create index %s on %s" % (name, cols))
+    if advised:
+        col.db.execute("analyze")
+    # see what the planner actually picks
+    used = set()
+    for sql, args in workload:
+        try:
+            plan = col.db.all("explain query plan " + sql, *args)
+        except:
+            continue
+        for row in plan:
+            used.update(re.findall(r"INDEX (\w+)", row[-1]))
+    have = _indexNames(col.db)
+    for name, cols, pat in _optionalIndices:
+        if name in have and name not in used:
+            col.db.execute("drop index %s" % name)
+    return indexSizes(col.db)
@@ -2,7 +2,8 @@
 # Copyright: Damien Elmes <anki@ichi2.net>
 # License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
 
-import urllib, os, sys, httplib2, gzip
+import urllib, os, sys, httplib2, gzip, httplib, ssl, zlib, base64, \
+    tempfile, urlparse, time, threading, Queue, socket
 from cStringIO import StringIO
 from datetime import date
 from anki.db import DB
@@ -12,14 +13,57 @@ from anki.consts import *
 from anki.lang import _
 from hooks import runHook
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 # syncing vars
 HTTP_TIMEOUT = 30
 HTTP_PROXY = None
+# request bodies larger than this are spooled to disk
+HTTP_SPOOL = 1024*1024
 
 # Httplib2 connection object
 ######################################################################
-
-def httpCon():
+# Connections are shared by all syncers in a thread and kept alive between
+# requests, so the meta, chunk and media calls of a sync reuse one socket
+# instead of repeating the TLS handshake.
+
+_pool = threading.local()
+_poolStats = dict(requests=0, connections=0)
+_poolLock = threading.Lock()
+
+def _countRequest(reused):
+    with _poolLock:
+        _poolStats['requests'] += 1
+        if not reused:
+            _poolStats['connections'] += 1
+
+def httpStats():
+    "Return the number of requests made and connections opened."
+    with _poolLock:
+        return dict(_poolStats)
+
+def resetHttp():
+    "Close this thread's pooled connections."
+    con = getattr(_pool, "con", None)
+    if con:
+        for c in con.connections.values():
+            c.close()
+        con.connections.clear()
+    for c in getattr(_pool, "stream", {}).values():
+        c[0].close()
+    _pool.stream = {}
+
+class _PooledHttp(httplib2.Http):
+
+    def _conn_request(self, conn, request_uri, method, body, headers):
+        _countRequest(conn.sock is not None)
+        return httplib2.Http._conn_request(
+            self, conn, request_uri, method, body, headers)
+
+def _certs():
     certs = os.path.join(os.path.dirname(__file__), "ankiweb.certs")
     if not os.path.exists(certs):
         if isWin:
@@ -32,9 +76,83 @@ def httpCon():
                 "../Resources/ankiweb.certs")
         else:
             assert 0
-    return httplib2.Http(
-        timeout=HTTP_TIMEOUT, ca_certs=certs,
-        proxy_info=HTTP_PROXY)
+    return certs
+
+def httpCon():
+    "Return this thread's shared connection object."
+    con = getattr(_pool, "con", None)
+    if not con:
+        con = _pool.con = _PooledHttp(
+            timeout=HTTP_TIMEOUT, ca_certs=_certs(),
+            proxy_info=HTTP_PROXY)
+    return con
+
+# Streaming connections
+######################################################################
+# httplib2 keeps both the request and the response in memory, which is too
+# much for full syncs of large collections. These requests go through
+# httplib instead, so the body can be sent from a file and the response
+# written out as it arrives.
+
+def streamCon(url):
+    """Return an httplib connection for URL, the path to request and headers.
+The connection is kept in this thread's pool."""
+    u = urlparse.urlsplit(url)
+    if not hasattr(_pool, "stream"):
+        _pool.stream = {}
+    key = (u.scheme, u.netloc)
+    if key not in _pool.stream:
+        _pool.stream[key] = _streamCon(u)
+    con, headers, absolute = _pool.stream[key]
+    if absolute:
+        # plain http proxies take the full url
+        return con, url, headers
+    return con, u.path + ("?" + u.query if u.query else ""), headers
+
+def _streamCon(u):
+    https = u.scheme == "https"
+    port = u.port or (443 if https else 80)
+    def con(host, port):
+        if https:
+            ctx = ssl.create_default_context(cafile=_certs())
+            return httplib.HTTPSConnection(
+                host, port, timeout=HTTP_TIMEOUT, context=ctx)
+        return httplib.HTTPConnection(host, port, timeout=HTTP_TIMEOUT)
+    p = HTTP_PROXY
+    if not p:
+        return con(u.hostname, port), {}, False
+    headers = {}
+    if p.proxy_user:
+        headers['Proxy-Authorization'] = "Basic " + base64.b64encode(
+            "%s:%s" % (p.proxy_user, p.proxy_pass))
+    c = con(p.proxy_host, p.proxy_port)
+    if https:
+        c.set_tunnel(u.hostname, port, headers)
+        return c, {}, False
+    return c, headers, True
+
+# Payload encoding
+######################################################################
+# Chunks and other sync payloads can be sent as msgpack, which is smaller
+# and quicker to encode than JSON. The client lists the formats it supports
+# in meta; servers that don't pick one get JSON.
+
+def syncFormats():
+    "Supported payload formats, best first."
+    if msgpack:
+        return ["msgpack", "json"]
+    return ["json"]
+
+def dumps(data, fmt="json"):
+    if fmt == "msgpack":
+        return msgpack.packb(data, use_bin_type=False)
+    return json.dumps(data)
+
+def loads(data, fmt="json"):
+    if fmt == "msgpack":
+        # strings come back as unicode, as they do from json
+        return msgpack.unpackb(data, raw=False)
+    return json.loads(data)
 
 # Proxy handling
 ######################################################################
@@ -77,6 +195,16 @@ from anki.consts import *
 
 class Syncer(object):
 
+    # chunks are limited by their approximate size in bytes; the client
+    # adjusts the limit so each upload takes about chunkTime seconds
+    chunkBytes = 1024*1024
+    chunkMinBytes = 64*1024
+    chunkMaxBytes = 16*1024*1024
+    chunkMaxRows = 50000
+    chunkTime = 2.0
+    # overlap network round trips with local work when the server is remote
+    pipeline = True
+
     def __init__(self, col, server=None):
         self.col = col
         self.server = server
@@ -112,20 +240,26 @@ class Syncer(object):
         self.mergeChanges(lchg, rchg)
         # step 3: stream large tables from server
         runHook("sync", "server")
-        while 1:
-            runHook("sync", "stream")
-            chunk = self.server.chunk()
-            self.applyChunk(chunk=chunk)
-            if chunk['done']:
-                break
+        if self.pipelined():
+            self.downloadPipelined()
+        else:
+            while 1:
+                runHook("sync", "stream")
+                chunk = self.server.chunk()
+                self.applyChunk(chunk=chunk)
+                if chunk['done']:
+                    break
         # step 4: stream to server
         runHook("sync", "client")
-        while 1:
-            runHook("sync", "stream")
-            chunk = self.chunk()
-            self.server.applyChunk(chunk=chunk)
-            if chunk['done']:
-                break
+        if self.pipelined():
+            self.uploadPipelined()
+        else:
+            while 1:
+                runHook("sync", "stream")
+                chunk = self.chunk()
+                self.sendChunk(chunk)
+                if chunk['done']:
+                    break
         # step 5: sanity check during beta testing
         runHook("sync", "sanity")
         c = self.sanityCheck()
@@ -142,6 +276,89 @@ Sanity check failed. Please copy and paste the text below:\n%s\n%s""" % (c, s))
     def meta(self):
         return (self.col.mod, self.col.scm, self.col._usn, intTime(), None)
 
+    # Pipelined chunks
+    ##########################################################################
+    # A worker thread talks to the server while this thread reads or writes
+    # the collection. Only the worker uses the server in the meantime, and
+    # only this thread uses the collection. Local servers have their own
+    # sqlite connection, which can't be shared with another thread.
+
+    def pipelined(self):
+        return self.pipeline and not isinstance(self.server, Syncer)
+
+    def sendChunk(self, chunk):
+        t = time.time()
+        self.server.applyChunk(chunk=chunk)
+        self.adaptChunk(time.time() - t)
+
+    def downloadPipelined(self):
+        "Apply each server chunk while the next one is being fetched."
+        q = Queue.Queue(maxsize=1)
+        stop = threading.Event()
+        def fetch():
+            try:
+                while not stop.is_set():
+                    chunk = self.server.chunk()
+                    q.put((chunk, None))
+                    if chunk['done']:
+                        break
+            except:
+                q.put((None, sys.exc_info()))
+        t = threading.Thread(target=fetch)
+        t.daemon = True
+        t.start()
+        try:
+            while 1:
+                runHook("sync", "stream")
+                chunk, err = q.get()
+                if err:
+                    raise err[0], err[1], err[2]
+                self.applyChunk(chunk=chunk)
+                if chunk['done']:
+                    break
+        finally:
+            stop.set()
+            # unblock the worker if it's waiting to hand over a chunk
+            while t.is_alive():
+                try:
+                    q.get(timeout=0.1)
+                except Queue.Empty:
+                    pass
+            t.join()
+
+    def uploadPipelined(self):
+        "Read each local chunk while the previous one is being sent."
+        q = Queue.Queue(maxsize=1)
+        errors = []
+        def send():
+            while 1:
+                chunk = q.get()
+                if chunk is None:
+                    break
+                if errors:
+                    # drain the queue so the reader doesn't block
+                    continue
+                try:
+                    self.sendChunk(chunk)
+                except:
+                    errors.append(sys.exc_info())
+        t = threading.Thread(target=send)
+        t.daemon = True
+        t.start()
+        try:
+            while not errors:
+                runHook("sync", "stream")
+                chunk = self.chunk()
+                q.put(chunk)
+                if chunk['done']:
+                    break
+        finally:
+            q.put(None)
+            t.join()
+        if errors:
+            err = errors[0]
+            raise err[0], err[1], err[2]
+
     def changes(self):
         "Bundle up small objects."
         d = dict(models=self.getModels(),
@@ -225,6 +442,8 @@ select count() from notes where id not in (select distinct nid from cards)""")
     def prepareToChunk(self):
         self.tablesLeft = ["revlog", "cards", "notes"]
         self.cursor = None
+        # bytes and rows read from each table so far
+        self.rowSize = {}
 
     def cursorForTable(self, table):
         lim = self.usnLim()
@@ -245,13 +464,27 @@ from notes where %s""" % d)
 
     def chunk(self):
         buf = dict(done=False)
-        lim = 2500
-        while self.tablesLeft and lim:
+        rowsLeft = self.chunkMaxRows
+        bytesLeft = self.chunkBytes
+        while self.tablesLeft and rowsLeft > 0 and bytesLeft > 0:
             curTable = self.tablesLeft[0]
             if not self.cursor:
                 self.cursor = self.cursorForTable(curTable)
+            if curTable in self.rowSize:
+                # take half the remaining space at a time, so an early
+                # estimate that's too low can't overshoot by much
+                size, cnt = self.rowSize[curTable]
+                lim = max(1, min(rowsLeft, bytesLeft * cnt / size / 2))
+            else:
+                # read a single row to estimate the rest
+                lim = 1
             rows = self.cursor.fetchmany(lim)
             fetched = len(rows)
+            if fetched:
+                size = self._rowBytes(rows)
+                old = self.rowSize.get(curTable, (0, 0))
+                self.rowSize[curTable] = (old[0] + size, old[1] + fetched)
+                bytesLeft -= size
             if fetched != lim:
                 # table is empty
                 self.tablesLeft.pop(0)
@@ -261,12 +494,33 @@ from notes where %s""" % d)
                     self.col.db.execute(
                         "update %s set usn=? where usn=-1"%curTable,
                         self.maxUsn)
-            buf[curTable] = rows
-            lim -= fetched
+            if curTable in buf:
+                buf[curTable].extend(rows)
+            else:
+                buf[curTable] = rows
+            rowsLeft -= fetched
         if not self.tablesLeft:
             buf['done'] = True
         return buf
 
+    def _rowBytes(self, rows):
+        "Approximate serialized size of ROWS."
+        size = 0
+        for row in rows:
+            for v in row:
+                if isinstance(v, basestring):
+                    size += len(v) + 3
+                else:
+                    size += 8
+        return size
+
+    def adaptChunk(self, elapsed):
+        "Adjust the chunk size after a chunk took ELAPSED seconds to send."
+        if elapsed > self.chunkTime:
+            self.chunkBytes = max(self.chunkMinBytes, self.chunkBytes / 2)
+        elif elapsed < self.chunkTime / 4:
+            self.chunkBytes = min(self.chunkMaxBytes, self.chunkBytes * 2)
+
     def applyChunk(self, chunk):
         if "revlog" in chunk:
             self.mergeRevlog(chunk['revlog'])
@@ -427,6 +681,7 @@ from notes where %s""" % d)
             "insert or replace into notes values (?,?,?,?,?,?,?,?,?,?,?)",
             rows)
         self.col.updateFieldCache([f[0] for f in rows])
+        self.col.tags.updateIndex([f[0] for f in rows])
 
     # Col config
     ##########################################################################
@@ -445,7 +700,8 @@ class LocalServer(Syncer):
     # serialize/deserialize payload, so we don't end up sharing objects
     # between cols
     def applyChanges(self, changes):
-        l = json.loads; d = json.dumps
+        fmt = syncFormats()[0]
+        l = lambda x: loads(x, fmt); d = lambda x: dumps(x, fmt)
         return l(d(Syncer.applyChanges(self, l(d(changes)))))
 
 # HTTP syncing tools
@@ -461,6 +717,8 @@ class HttpSyncer(object):
     def __init__(self, hkey=None, con=None):
         self.hkey = hkey
         self.con = con or httpCon()
+        # payload format agreed with the server
+        self.fmt = "json"
 
     def assertOk(self, resp):
         if resp['status'] != '200':
@@ -474,14 +732,76 @@ class HttpSyncer(object):
 
     def req(self, method, fobj=None, comp=6,
                  badAuthRaises=True, hkey=True):
+        buf, headers = self._body(fobj, comp, hkey)
+        body = buf.read()
+        buf.close()
+        resp, cont = self.con.request(
+            SYNC_URL+method, "POST", headers=headers, body=body)
+        if not badAuthRaises:
+            # return false if bad auth instead of raising
+            if resp['status'] == '403':
+                return False
+        self.assertOk(resp)
+        return cont
+
+    def streamReq(self, method, fobj=None, comp=6, tgt=None, hkey=True):
+        """Like req(), but the body is sent from a temporary file. If TGT is
+provided, the response is written to it and None is returned."""
+        buf, headers = self._body(fobj, comp, hkey)
+        con, path, extra = streamCon(SYNC_URL+method)
+        headers.update(extra)
+        headers['Accept-Encoding'] = "gzip"
+        try:
+            for attempt in range(2):
+                reused = con.sock is not None
+                try:
+                    con.request("POST", path, buf, headers)
+                    resp = con.getresponse()
+                except (socket.error, httplib.HTTPException):
+                    con.close()
+                    if not reused:
+                        raise
+                    # the server closed the idle connection; try once more
+                    # on a fresh one
+                    buf.seek(0)
+                    continue
+                _countRequest(reused)
+                break
+            self.assertOk(dict(status=str(resp.status)))
+            if resp.getheader("content-encoding") == "gzip":
+                dec = zlib.decompressobj(16+zlib.MAX_WBITS)
+            else:
+                dec = None
+            out = tgt or StringIO()
+            while 1:
+                data = resp.read(65536)
+                if not data:
+                    break
+                if dec:
+                    data = dec.decompress(data)
+                out.write(data)
+            if dec:
+                out.write(dec.flush())
+        except:
+            con.close()
+            raise
+        finally:
+            buf.close()
+        if not tgt:
+            return out.getvalue()
+
+    def _body(self, fobj, comp, hkey):
+        "Return the multipart body in a file, and the headers to send it."
         BOUNDARY="Anki-sync-boundary"
         bdry = "--"+BOUNDARY
-        buf = StringIO()
+        buf = tempfile.SpooledTemporaryFile(max_size=HTTP_SPOOL)
         # compression flag and session key as post vars
         vars = {}
         vars['c'] = 1 if comp else 0
         if hkey:
             vars['k'] = self.hkey
+        if self.fmt != "json":
+            vars['f'] = self.fmt
         for (key, value) in vars.items():
             buf.write(bdry + "\r\n")
             buf.write(
@@ -508,21 +828,13 @@ Content-Type: application/octet-stream\r\n\r\n""")
                 tgt.write(data)
             buf.write('\r\n' + bdry + '--\r\n')
         size = buf.tell()
+        buf.seek(0)
         # connection headers
         headers = {
             'Content-Type': 'multipart/form-data; boundary=%s' % BOUNDARY,
             'Content-Length': str(size),
         }
-        body = buf.getvalue()
-        buf.close()
-        resp, cont = self.con.request(
-            SYNC_URL+method, "POST", headers=headers, body=body)
-        if not badAuthRaises:
-            # return false if bad auth instead of raising
-            if resp['status'] == '403':
-                return False
-        self.assertOk(resp)
-        return cont
+        return buf, headers
 
 # Incremental sync over HTTP
 ######################################################################
@@ -545,12 +857,16 @@ class RemoteServer(HttpSyncer):
 
     def meta(self):
         ret = self.req(
-            "meta", StringIO(json.dumps(dict(v=SYNC_VER))),
+            "meta", StringIO(json.dumps(dict(v=SYNC_VER, f=syncFormats()))),
             badAuthRaises=False)
         if not ret:
             # invalid auth
             return
-        return json.loads(ret)
+        ret = json.loads(ret)
+        # servers that understand the format list append their choice
+        if len(ret) > 5 and ret[5] in syncFormats():
+            self.fmt = ret[5]
+        return ret[:5]
 
     def applyChanges(self, **kw):
         return self._run("applyChanges", kw)
@@ -571,8 +887,8 @@ class RemoteServer(HttpSyncer):
         return self._run("finish", kw)
 
     def _run(self, cmd, data):
-        return json.loads(
-            self.req(cmd, StringIO(json.dumps(data))))
+        return loads(
+            self.req(cmd, StringIO(dumps(data, self.fmt))), self.fmt)
 
 # Full syncing
 ##########################################################################
@@ -586,12 +902,13 @@ class FullSyncer(HttpSyncer):
     def download(self):
         runHook("sync", "download")
         self.col.close()
-        cont = self.req("download")
         tpath = self.col.path + ".tmp"
-        if cont == "upgradeRequired":
+        with open(tpath, "wb") as tgt:
+            self.streamReq("download", tgt=tgt)
+        if open(tpath, "rb").read(100) == "upgradeRequired":
+            os.unlink(tpath)
             runHook("sync", "upgradeRequired")
             return
-        open(tpath, "wb").write(cont)
         # check the received file is ok
         d = DB(tpath)
         assert d.scalar("pragma integrity_check") == "ok"
@@ -607,7 +924,8 @@ class FullSyncer(HttpSyncer):
         assert self.col.db.scalar("pragma integrity_check") == "ok"
         # apply some adjustments, then upload
         self.col.beforeUpload()
-        assert self.req("upload", open(self.col.path, "rb")) == "OK"
+        with open(self.col.path, "rb") as f:
+            assert self.streamReq("upload", f) == "OK"
 
 # Media syncing
 ##########################################################################
@@ -20,10 +20,12 @@ class TagManager(object):
 
     def __init__(self, col):
         self.col = col
+        self._index = None
 
     def load(self, json_):
         self.tags = json.loads(json_)
         self.changed = False
+        self.col.finder.clearCache()
 
     def flush(self):
         if self.changed:
@@ -45,6 +47,7 @@ class TagManager(object):
                 self.tags[t] = self.col.usn() if usn is None else usn
                 self.changed = True
         if found:
+            self.col.finder.clearCache()
             runHook("newTag")
 
     def all(self):
@@ -85,13 +88,20 @@ class TagManager(object):
         else:
             l = "tags "
             fn = self.remFromStr
-        lim = " or ".join(
-            [l+"like :_%d" % c for c, t in enumerate(newTags)])
+        if self.hasIndex():
+            l = "id not in " if add else "id in "
+            lim = " or ".join(
+                [l+"(select nid from note_tags where tag = :_%d)" % c
+                 for c, t in enumerate(newTags)])
+            args = dict([("_%d" % x, y) for x, y in enumerate(newTags)])
+        else:
+            lim = " or ".join(
+                [l+"like :_%d" % c for c, t in enumerate(newTags)])
+            args = dict([("_%d" % x, '%% %s %%' % y)
+                         for x, y in enumerate(newTags)])
         res = self.col.db.all(
             "select id, tags from notes where id in %s and (%s)" % (
-                ids2str(ids), lim),
-            **dict([("_%d" % x, '%% %s %%' % y)
-                    for x, y in enumerate(newTags)]))
+                ids2str(ids), lim), **args)
         # update tags
         nids = []
         def fix(row):
@@ -101,10 +111,58 @@ class TagManager(object):
         self.col.db.executemany(
             "update notes set tags=:t,mod=:n,usn=:u where id = :id",
             [fix(row) for row in res])
+        self.updateIndex(nids)
 
     def bulkRem(self, ids, tags):
         self.bulkAdd(ids, tags, False)
 
+    # Tag index
+    #############################################################
+    # An optional note_tags table with a row for each tag on each note, which
+    # tag searches and bulk changes use instead of scanning notes.tags. It's
+    # only kept locally, so it's dropped before a full upload.
+
+    def enableIndex(self):
+        if self.hasIndex():
+            return
+        self.col.db.execute("""
+create table note_tags (nid integer not null, tag text not null collate nocase,
+primary key (nid, tag))""")
+        self.col.db.execute("create index ix_note_tags_tag on note_tags (tag)")
+        self._index = True
+        self.updateIndex()
+        # an index rolled back to empty would hide matches
+        self.col.db.commit()
+        self.col.finder.clearCache()
+
+    def disableIndex(self):
+        if self.hasIndex():
+            self.col.db.execute("drop table note_tags")
+            self.col.finder.clearCache()
+        self._index = False
+
+    def hasIndex(self):
+        if self._index is None:
+            self._index = bool(self.col.db.scalar(
+                "select 1 from sqlite_master where name = 'note_tags'"))
+        return self._index
+
+    def updateIndex(self, nids=None):
+        "Refresh the index rows of NIDS, or all notes."
+        if not self.hasIndex():
+            return
+        if nids is None:
+            lim = ""
+            self.col.db.execute("delete from note_tags")
+        else:
+            lim = " where id in " + ids2str(nids)
+            self.col.db.execute("delete from note_tags where nid in "+
+                                ids2str(nids))
+        self.col.db.executemany(
+            "insert or ignore into note_tags values (?,?)",
+            ((nid, tag) for nid, tags in self.col.db.all(
+                "select id, tags from notes"+lim) for tag in self.split(tags)))
+
     # String-based utilities
     ##########################################################################
 
@@ -157,4 +215,5 @@ class TagManager(object):
     def beforeUpload(self):
         for k in self.tags.keys():
             self.tags[k] = 0
+        self.disableIndex()
         self.save()
@@ -4,6 +4,7 @@ import os, re, datetime
 from tests.shared import assertException, getEmptyDeck, testDir, \
     getUpgradeDeckPath
 from anki.stdmodels import addBasicModel
+from anki.storage import adviseIndices, updateAdvisedIndices
 from anki.consts import *
 
 from anki import Collection as aopen
@@ -119,6 +120,43 @@ def test_timestamps():
         addBasicModel(deck)
     assert len(deck.models.models) == 102
 
+def test_indexAdvisor():
+    deck = getEmptyDeck()
+    for i in range(20):
+        f = deck.newNote()
+        f['Front'] = u"%d" % i
+        deck.addNote(f)
+    # nothing recorded, nothing to do
+    assert adviseIndices(deck) == []
+    deck.finder.instrument = True
+    deck.findCards("note:Basic")
+    assert adviseIndices(deck) == [("ix_notes_mid", 1)]
+    deck.optimize()
+    assert "ix_notes_mid" in deck.db.list(
+        "select name from sqlite_master where type = 'index'")
+    deck.finder.clearStats()
+    deck.findCards("note:Basic")
+    assert "ix_notes_mid" in " ".join(deck.finder.stats()[0]['plan'])
+    # dropped once the workload no longer uses it
+    deck.finder.clearStats()
+    deck.findCards("one")
+    assert updateAdvisedIndices(deck) == {}
+    assert "ix_notes_mid" not in deck.db.list(
+        "select name from sqlite_master where type = 'index'")
+    # the standard indices are left alone
+    assert "ix_cards_sched" in deck.db.list(
+        "select name from sqlite_master where type = 'index'")
+    # interval searches get an index on the interval alone, which leaves
+    # the scheduler's queries on ix_cards_sched
+    deck.db.execute("update cards set ivl = id % 50")
+    deck.finder.clearStats()
+    deck.findCards("prop:ivl>30")
+    assert "ix_cards_ivl" in updateAdvisedIndices(deck)
+    assert deck.db.first("pragma index_info(ix_cards_ivl)")[2] == "ivl"
+    plan = deck.db.all("""explain query plan select * from cards
+where did = 1 and queue = 0 order by due, id limit 10""")
+    assert "ix_cards_sched" in " ".join(r[-1] for r in plan)
+
 def test_furigana():
     deck = getEmptyDeck()
     mm = deck.models
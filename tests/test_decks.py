@@ -88,6 +88,26 @@ def test_rename():
     for n in "yo", "yo::two", "yo::two::three":
         assert n in d.decks.allNames()
 
+def test_tree():
+    d = getEmptyDeck()
+    three = d.decks.id("one::two::three")
+    one = d.decks.id("one")
+    two = d.decks.id("one::two")
+    assert [g['id'] for g in d.decks.parents(three)] == [one, two]
+    assert sorted(x[1] for x in d.decks.children(one)) == sorted([two, three])
+    # the index follows renames and removals
+    d.decks.rename(d.decks.get(two), "four")
+    assert d.decks.id("four", create=False) == two
+    assert d.decks.id("one::two", create=False) is None
+    assert d.decks.children(one) == []
+    assert [g['id'] for g in d.decks.parents(three)] == [two]
+    d.decks.rem(three)
+    assert d.decks.children(two) == []
+    # missing parents are recreated, as before
+    d.decks.decks[str(two)]['name'] = "x::y"
+    d.decks.update(d.decks.get(two))
+    assert [g['name'] for g in d.decks.parents(two)] == ["x"]
+
 def test_renameForDragAndDrop():
     d = getEmptyDeck()
 
@@ -1,6 +1,9 @@
 # coding: utf-8
 
+import re
+import anki.find
 from anki.find import Finder
+from anki.hooks import addHook, remHook
 from tests.shared import getEmptyDeck
 
 def test_parse():
@@ -106,6 +109,9 @@ def test_findCards():
     assert len(deck.findCards("-back:sheep")) == 3
     assert len(deck.findCards("front:do")) == 0
     assert len(deck.findCards("front:*")) == 5
+    assert len(deck.findCards("front:*o*")) == 2
+    # invalid patterns find nothing
+    assert not deck.findCards("front:(")
     # ordering
     deck.conf['sortType'] = "noteCrt"
     assert deck.findCards("front:*", order=True)[-1] in latestCardIds
@@ -215,6 +221,180 @@ def test_findCards():
     assert len(deck.findCards("added:1")) == deck.cardCount() - 1
     assert len(deck.findCards("added:2")) == deck.cardCount()
 
+def test_textIndex():
+    deck = getEmptyDeck()
+    for front, back in ((u"dog", u"<b>Cat</b>fish"), (u"goats are fun",
+                        u"sheep"), (u"caterpillar", u"s\u00e9parer")):
+        f = deck.newNote()
+        f['Front'] = front
+        f['Back'] = back
+        deck.addNote(f)
+    queries = (u"cat", u"CAT", u"catfish", u"cat*pillar", u"goat_", u"do",
+               u"b>cat", u"s\u00e9p", u"-sheep", u"fun or fish", u"dog_")
+    plain = [sorted(deck.findCards(q)) for q in queries]
+    assert deck.enableTextIndex()
+    assert deck.hasTextIndex()
+    assert [sorted(deck.findCards(q)) for q in queries] == plain
+    assert len(deck.findNotes("cat")) == 2
+    # short terms don't use the index
+    deck.db.execute("delete from notes_fts")
+    assert not deck.findCards("cat")
+    assert len(deck.findCards("do")) == 1
+    deck.updateFieldCache(deck.db.list("select id from notes"))
+    # edits and removals are reflected
+    f['Front'] = u"wolf"
+    f.flush()
+    assert len(deck.findCards("wolf")) == 1
+    assert len(deck.findCards("cat")) == 1
+    deck.remNotes([f.id])
+    assert not deck.findCards("wolf")
+    assert not deck.db.scalar("select 1 from notes_fts where rowid = ?", f.id)
+    deck.disableTextIndex()
+    assert not deck.hasTextIndex()
+    assert len(deck.findCards("cat")) == 1
+
+def test_pages():
+    deck = getEmptyDeck()
+    for i in range(10):
+        f = deck.newNote()
+        f['Front'] = u"%02d" % i
+        deck.addNote(f)
+    deck.conf['sortType'] = "noteFld"
+    full = deck.findCards("", order=True)
+    assert len(full) == 10
+    assert deck.findCards("", order=True, limit=3) == full[:3]
+    assert deck.findCards("", order=True, limit=3, offset=8) == full[8:]
+    assert list(deck.finder.iterCards("", order=True, pageSize=4)) == full
+    # descending order is done in sql
+    deck.conf['sortBackwards'] = True
+    assert deck.findCards("", order=True) == list(reversed(full))
+    assert deck.findCards("", order=True, limit=2) == full[:-3:-1]
+    nids = deck.findNotes("")
+    assert deck.findNotes("", limit=5) + deck.findNotes(
+        "", limit=5, offset=5) == sorted(nids)
+    assert not list(deck.finder.iterCards("prop:foo"))
+
+def test_counts():
+    deck = getEmptyDeck()
+    for front, tags in ((u"dog", u"one"), (u"cat", u"two"), (u"cow", u"")):
+        f = deck.newNote()
+        f['Front'] = front
+        f.tags = deck.tags.split(tags)
+        deck.addNote(f)
+    queries = ["", "c*", "tag:one or tag:two", "is:due", "prop:foo",
+               "front:c* -tag:two", "deck:nosuchdeck"]
+    counts = [len(deck.findCards(q)) for q in queries]
+    assert counts == [3, 2, 2, 0, 0, 1, 0]
+    assert [deck.finder.countCards(q) for q in queries] == counts
+    assert deck.finder.countCardsBatch(queries) == counts
+    assert deck.finder.countCardsBatch([]) == []
+    assert deck.finder.countNotes("c*") == len(deck.findNotes("c*")) == 2
+    assert deck.finder.countNotes("prop:foo") == 0
+
+def test_tagIndex():
+    deck = getEmptyDeck()
+    for tags in (u"foo bar", u"Foo::baz", u"food", u""):
+        f = deck.newNote()
+        f['Front'] = tags or u"x"
+        f.tags = deck.tags.split(tags)
+        deck.addNote(f)
+    queries = ("tag:foo", "tag:FOO", "tag:foo*", "tag:*baz", "tag:none",
+               "-tag:bar", "tag:fo")
+    plain = [sorted(deck.findCards(q)) for q in queries]
+    deck.tags.enableIndex()
+    assert deck.tags.hasIndex()
+    assert [sorted(deck.findCards(q)) for q in queries] == plain
+    # bulk changes, edits and removals keep it up to date
+    nids = deck.db.list("select id from notes order by id")
+    deck.tags.bulkAdd(nids, u"new")
+    assert len(deck.findCards("tag:new")) == 4
+    deck.tags.bulkRem(nids[:2], u"new foo")
+    assert len(deck.findCards("tag:new")) == 2
+    assert not deck.findCards("tag:foo")
+    f.tags = [u"last"]
+    f.flush()
+    assert deck.findCards("tag:last") == [f.cards()[0].id]
+    assert len(deck.findCards("tag:new")) == 1
+    deck.remNotes([f.id])
+    assert not deck.db.scalar("select 1 from note_tags where nid = ?", f.id)
+    assert deck.db.scalar("select count() from note_tags") == 4
+    deck.tags.disableIndex()
+    assert len(deck.findCards("tag:new")) == 1
+
+def test_planCache():
+    deck = getEmptyDeck()
+    f = deck.newNote()
+    f['Front'] = u"one"
+    deck.addNote(f)
+    did = deck.decks.id("foo")
+    finder = deck.finder
+    compiled = []
+    tokenize = finder._tokenize
+    def countingTokenize(query):
+        compiled.append(query)
+        return tokenize(query)
+    finder._tokenize = countingTokenize
+    assert len(deck.findCards("deck:default one")) == 1
+    assert len(deck.findCards("deck:default one")) == 1
+    assert len(compiled) == 1
+    # a different order is a different plan
+    deck.findCards("deck:default one", order=True)
+    assert len(compiled) == 2
+    # deck changes invalidate
+    deck.decks.rename(deck.decks.get(1), "bar")
+    assert not deck.findCards("deck:default one")
+    assert len(compiled) == 3
+    deck.db.execute("update cards set did = ?", did)
+    assert len(deck.findCards("deck:foo")) == 1
+    # as do model changes
+    deck.findCards("note:basic")
+    deck.models.save(deck.models.current())
+    deck.findCards("note:basic")
+    assert compiled.count("note:basic") == 2
+    # field searches are evaluated in sql, so cached plans see edits
+    assert len(deck.findCards("front:one")) == 1
+    f['Front'] = u"two"
+    f.flush()
+    assert not deck.findCards("front:one")
+    assert compiled.count("front:one") == 1
+    # the cache is bounded
+    finder.cacheSize = 2
+    for q in "a", "b", "c":
+        deck.findCards(q)
+    assert len(finder._plans) == 2
+
+def test_stats():
+    deck = getEmptyDeck()
+    f = deck.newNote()
+    f['Front'] = u'one'
+    deck.addNote(f)
+    # off by default
+    deck.findCards("one")
+    assert deck.finder.stats() == []
+    seen = []
+    addHook("search", seen.append)
+    deck.finder.instrument = True
+    assert len(deck.findCards("one")) == 1
+    assert deck.finder.countCards("is:new") == 1
+    remHook("search", seen.append)
+    st = deck.finder.stats()
+    assert seen == st
+    assert [s['query'] for s in st] == ["one", "is:new"]
+    assert st[0]['rows'] == 1
+    assert st[0]['compileTime'] >= 0 and st[0]['execTime'] >= 0
+    assert st[0]['plan']
+    # card type isn't indexed; older sqlite versions say "SCAN TABLE cards
+    # AS c" instead
+    assert len(st[1]['scans']) == 1
+    assert re.search(r"\b(c|cards)\b", st[1]['scans'][0])
+    # the log is bounded
+    deck.finder.statsSize = 2
+    deck.findCards("two")
+    deck.findCards("three")
+    assert [s['query'] for s in deck.finder.stats()] == ["two", "three"]
+    deck.finder.clearStats()
+    assert deck.finder.stats() == []
+
 def test_findReplace():
     deck = getEmptyDeck()
     f = deck.newNote()
@@ -241,6 +421,18 @@ def test_findReplace():
     f.load(); assert f['Back'] != "reg"
     assert deck.findReplace(nids, "B.r", "reg", regex=True) == 1
     f.load(); assert f['Back'] == "reg"
+    # anchors apply to each field
+    assert deck.findReplace(nids, "^qux$", "foo", regex=True) == 1
+    f2.load(); assert f2['Back'] == "foo"
+    # progress is reported per batch
+    seen = []
+    def onProgress(done, total, cnt):
+        seen.append((done, total, cnt))
+    addHook("findReplace", onProgress)
+    assert anki.find.findReplace(deck, nids, "foo", "bar", batchSize=1) == 2
+    remHook("findReplace", onProgress)
+    assert seen == [(1, 2, 1), (2, 2, 2)]
+    f.load(); assert f['Front'] == "bar"
 
 def test_findDupes():
     deck = getEmptyDeck()
@@ -272,3 +464,36 @@ def test_findDupes():
     assert not r
     # front isn't dupe
     assert deck.findDupes("Front") == []
+
+def test_dupeIndex():
+    deck = getEmptyDeck()
+    for front, back in ((u'foo', u'bar'), (u'baz', u'bar'),
+                        (u'quux', u'<b>bar</b>'), (u'quuux', u'nope')):
+        f = deck.newNote()
+        f['Front'] = front
+        f['Back'] = back
+        deck.addNote(f)
+    nids = sorted(deck.db.list("select id from notes"))
+    plain = deck.findDupes("Back")
+    deck.enableDupeIndex()
+    assert deck.hasDupeIndex()
+    assert deck.findDupes("Back") == plain
+    assert deck.findDupes("Back") == [(u"bar", nids[:2])]
+    assert deck.findDupes("Back", "foo") == []
+    assert deck.findDupes("Front") == []
+    # recheck after an edit
+    f = deck.getNote(nids[3])
+    f['Back'] = u'bar'
+    f.flush()
+    r = deck.findDupes("Back", nids=[nids[3]])
+    assert r == [(u"bar", nids[:2] + [nids[3]])]
+    assert deck.findDupes("Back", nids=[nids[2]]) == []
+    # removed notes drop out
+    deck.remNotes([nids[0]])
+    assert deck.findDupes("Back") == [(u"bar", [nids[1], nids[3]])]
+    # moving a field keeps the index in step
+    m = deck.models.current()
+    deck.models.moveField(m, m['flds'][1], 0)
+    assert deck.findDupes("Back") == [(u"bar", [nids[1], nids[3]])]
+    deck.disableDupeIndex()
+    assert deck.findDupes("Back") == [(u"bar", [nids[1], nids[3]])]
@@ -3,7 +3,7 @@
 import time, copy
 from tests.shared import assertException, getEmptyDeck
 from anki.utils import stripHTML, intTime
-from anki.hooks import addHook
+from anki.hooks import addHook, remHook
 from anki.consts import *
 
 def test_basics():
@@ -83,6 +83,26 @@ def test_newLimits():
     d.reset()
     assert d.sched.newCount == 9
 
+def test_lazyDayRollover():
+    d = getEmptyDeck()
+    for i in range(30):
+        f = d.newNote()
+        f['Front'] = str(i)
+        d.addNote(f)
+    other = d.decks.get(d.decks.id("other"))
+    d.decks.select(1)
+    # counts left over from yesterday
+    for g in d.decks.get(1), other:
+        g['newToday'] = [d.sched.today - 1, 15]
+    d.reset()
+    # are ignored by the limits
+    assert d.sched.newCount == 20
+    # and the inactive deck isn't touched until it's used
+    assert other['newToday'] == [d.sched.today - 1, 15]
+    c = d.sched.getCard()
+    d.sched.answerCard(c, 3)
+    assert d.decks.get(1)['newToday'] == [d.sched.today, 1]
+
 def test_newBoxes():
     d = getEmptyDeck()
     f = d.newNote()
@@ -621,6 +641,45 @@ def test_cram():
     # it should have been moved back to the original deck
     assert c.did == 1
 
+def test_cram_order():
+    d = getEmptyDeck()
+    for ivl in 1, 3, 2:
+        f = d.newNote()
+        f['Front'] = u"%d" % ivl
+        d.addNote(f)
+        c = f.cards()[0]
+        c.type = c.queue = 2
+        c.ivl = ivl
+        c.flush()
+    did = d.decks.newDyn("Cram")
+    d.decks.get(did)['terms'][0][2] = DYN_BIGINT
+    rebuilt = []
+    def onRebuild(*args):
+        rebuilt.append(args)
+    addHook("rebuildDyn", onRebuild)
+    assert d.sched.rebuildDyn(did) == 3
+    assert rebuilt[0][:2] == (did, 3)
+    # cards are positioned in search order
+    assert d.db.list("select ivl from cards where did = ? order by due",
+                     did) == [3, 2, 1]
+    # nothing matching
+    d.decks.get(did)['terms'][0][0] = u"nosuchtext"
+    assert not d.sched.rebuildDyn(did)
+    assert rebuilt[1][:2] == (did, 0)
+    assert not d.db.scalar("select 1 from cards where did = ?", did)
+    remHook("rebuildDyn", onRebuild)
+    # the rebuild doesn't commit earlier changes along the way
+    d = getEmptyDeck()
+    f = d.newNote()
+    f['Front'] = u"one"
+    d.addNote(f)
+    did = d.decks.newDyn("Cram")
+    d.save()
+    d.db.execute("update cards set factor = 1234")
+    d.sched.rebuildDyn(did)
+    d.db.rollback()
+    assert not d.db.scalar("select 1 from cards where factor = 1234")
+
 def test_cram_rem():
     d = getEmptyDeck()
     f = d.newNote()
@@ -815,6 +874,35 @@ def test_adjIvl():
     d.sched.answerCard(c, 3)
     assert c.ivl == 19
 
+def test_siblingIndex():
+    d = getEmptyDeck()
+    m = d.models.current(); mm = d.models
+    t = mm.newTemplate("Reverse")
+    t['qfmt'] = "{{Back}}"
+    t['afmt'] = "{{Front}}"
+    mm.addTemplate(m, t)
+    mm.save(m)
+    f = d.newNote()
+    f['Front'] = "1"; f['Back'] = "1"
+    d.addNote(f)
+    d.reset()
+    c = d.sched.getCard()
+    # siblings were loaded along with the queue
+    assert d.sched._sibDues == {f.id: {}}
+    d.sched.answerCard(c, 3)
+    assert d.sched._sibDues[f.id] == {c.id: c.due}
+    # the second card is spaced away without querying the siblings
+    c2 = d.sched.getCard()
+    execute = d.db.execute
+    def check(sql, *a, **kw):
+        assert "type = 2" not in sql
+        return execute(sql, *a, **kw)
+    d.db.execute = check
+    d.sched.answerCard(c2, 3)
+    d.db.execute = execute
+    assert c2.due != c.due
+    assert d.sched._sibDues[f.id] == {c.id: c.due, c2.id: c2.due}
+
 def test_ordcycle():
     d = getEmptyDeck()
     # add two more templates and set second active
@@ -953,6 +1041,141 @@ def test_collapse():
     d.sched.answerCard(c, 3)
     assert not d.sched.getCard()
 
+def test_prefetch():
+    d = getEmptyDeck()
+    for i in range(4):
+        f = d.newNote()
+        f['Front'] = str(i)
+        d.addNote(f)
+    cids = d.db.list("select id from cards order by id")
+    d.sched.reschedCards(cids[:2], 0, 0)
+    d.reset()
+    # queued cards are fetched in bulk, not loaded one by one
+    from anki.cards import Card
+    load = Card.load
+    def fail(self):
+        assert 0
+    Card.load = fail
+    try:
+        seen = []
+        for i in range(4):
+            c = d.sched.getCard()
+            seen.append(c.id)
+            assert c.nid and c.ord == 0
+    finally:
+        Card.load = load
+    assert sorted(seen) == cids
+
+def test_prefetchOrder():
+    d = getEmptyDeck()
+    for i in range(30):
+        f = d.newNote()
+        f['Front'] = str(i)
+        d.addNote(f)
+    # new card positions run against the card ids
+    cids = d.db.list("select id from cards order by id")
+    d.db.executemany("update cards set due = ? where id = ?",
+                     [(300 - i, cid) for i, cid in enumerate(cids)])
+    # with statistics, sqlite may no longer walk the sched index
+    d.db.execute("analyze")
+    d.sched.queueLimit = 5
+    d.reset()
+    dues = [d.sched.getCard().due for i in range(5)]
+    assert dues == [271, 272, 273, 274, 275]
+
+def test_answerCards():
+    d = getEmptyDeck()
+    child = d.decks.id("Default::child")
+    for i in range(6):
+        f = d.newNote()
+        f['Front'] = str(i)
+        f.model()['did'] = child if i % 2 else 1
+        d.addNote(f)
+    cids = d.db.list("select id from cards order by id")
+    d.sched.reschedCards(cids[:2], 0, 0)
+    d.reset()
+    answers = []
+    for i, cid in enumerate(cids):
+        answers.append((d.getCard(cid), [3, 1][i % 2], 5000))
+    d.sched.answerCards(answers)
+    assert d.db.scalar("select count() from revlog") == 6
+    assert d.db.scalar("select count(distinct id) from revlog") == 6
+    assert d.db.scalar("select sum(time) from revlog") == 30000
+    for c, ease, taken in answers:
+        assert d.db.scalar("select queue from cards where id = ?",
+                           c.id) == c.queue
+    # stats were applied to each deck and its parents
+    assert d.decks.get(1)['timeToday'][1] == 30000
+    assert d.decks.get(child)['timeToday'][1] == 15000
+    assert d.decks.get(1)['newToday'][1] == 4
+    assert d.decks.get(1)['revToday'][1] == 2
+    # bulk answers aren't undoable
+    assert not d.undoName()
+    # one relearning step for the lapse, two steps for each failed new card
+    assert d.sched.counts()[1] == 5
+    d.reset()
+    assert d.sched.counts() == (0, 5, 0)
+    # replaying on a scheduler that was never reset
+    d = getEmptyDeck()
+    for i in range(2):
+        f = d.newNote()
+        f['Front'] = str(i)
+        d.addNote(f)
+    cids = d.db.list("select id from cards order by id")
+    d.sched.answerCards([(d.getCard(cids[0]), 1, 1000)])
+    assert d.db.scalar("select queue from cards where id = ?", cids[0]) == 1
+    # a failed batch writes nothing and leaves the counts intact
+    d.reset()
+    assert d.sched.counts() == (1, 2, 0)
+    c = d.getCard(cids[1])
+    bad = d.getCard(cids[0])
+    bad.queue = -1
+    assertException(Exception, lambda: d.sched.answerCards(
+        [(c, 3, 1000), (bad, 3, 1000)]))
+    assert d.db.scalar("select queue from cards where id = ?", cids[1]) == 0
+    d.reset()
+    assert d.sched.counts() == (1, 2, 0)
+
+def test_dueCountCache():
+    d = getEmptyDeck()
+    for i in range(6):
+        f = d.newNote()
+        f['Front'] = str(i)
+        d.addNote(f)
+    cids = d.db.list("select id from cards order by id")
+    d.sched.reschedCards(cids[:3], 0, 0)
+    d.reset()
+    assert d.sched.counts() == (3, 0, 3)
+    def check():
+        # the incrementally maintained counts match a full rebuild
+        cached = dict(d.sched._dueCounts)
+        stamp = d.sched._dueStamp
+        d.reset()
+        assert d.sched._dueStamp == stamp
+        d.sched._dueCounts = None
+        d.reset()
+        assert dict((k, v) for k, v in cached.items() if v) == \
+            d.sched._dueCounts
+    d.sched.suspendCards([cids[0], cids[3]])
+    check()
+    assert d.sched.counts() == (2, 0, 2)
+    d.sched.unsuspendCards([cids[0]])
+    check()
+    d.sched.forgetCards([cids[1]])
+    check()
+    d.sched.buryNote(d.getCard(cids[4]).nid)
+    check()
+    d.remCards([cids[5]])
+    check()
+    assert d.sched.counts() == (1, 0, 2)
+    c = d.sched.getCard()
+    d.sched.answerCard(c, 3)
+    check()
+    # changes made behind the scheduler's back force a rebuild
+    d.db.execute("update cards set queue = 0, type = 0")
+    d.reset()
+    assert d.sched.counts() == (5, 0, 0)
+
 def test_deckDue():
     d = getEmptyDeck()
     # add a note with default deck
@@ -1003,6 +1226,26 @@ def test_deckDue():
     d.sched.deckDueList()
     d.sched.deckDueTree()
 
+def test_deckDueLimits():
+    d = getEmptyDeck()
+    child = d.decks.id("Default::child")
+    for i in range(30):
+        f = d.newNote()
+        f['Front'] = str(i)
+        f.model()['did'] = child if i % 2 else 1
+        d.addNote(f)
+    # parent limit of 10 caps the child as well
+    d.decks.confForDid(1)['new']['perDay'] = 10
+    cnts = d.sched.deckDueList()
+    assert cnts[0] == ["Default", 1, 0, 0, 10]
+    assert cnts[1] == ["Default::child", child, 0, 0, 10]
+    # learning cards are reported by remaining steps
+    d.reset()
+    c = d.sched.getCard()
+    d.sched.answerCard(c, 1)
+    cnts = d.sched.deckDueList()
+    assert cnts[0][3] + cnts[1][3] == 2
+
 def test_deckTree():
     d = getEmptyDeck()
     d.decks.id("new::b::c")
@@ -1036,6 +1279,81 @@ def test_deckFlow():
         assert c.note()['Front'] == i
         d.sched.answerCard(c, 2)
 
+def test_interleavedFlow():
+    d = getEmptyDeck()
+    d.conf['interleaveDecks'] = True
+    # same notes as above; with interleaving they come in due order
+    for name, deck in (("one", "Default"), ("two", "Default::2"),
+                       ("three", "Default::1")):
+        f = d.newNote()
+        f['Front'] = unicode(name)
+        f.model()['did'] = d.decks.id(deck)
+        d.addNote(f)
+    d.reset()
+    assert d.sched.counts() == (3,0,0)
+    for i in "one", "two", "three":
+        c = d.sched.getCard()
+        assert c.note()['Front'] == i
+        d.sched.answerCard(c, 2)
+    # reviews in two children, limited by the shared parent
+    d = getEmptyDeck()
+    d.conf['interleaveDecks'] = True
+    d.sched.pageLimit = 4
+    conf = d.decks.confForDid(1)
+    conf['rev']['perDay'] = 20
+    d.decks.save(conf)
+    dids = [d.decks.id("Default::1"), d.decks.id("Default::2")]
+    for i in range(30):
+        f = d.newNote()
+        f['Front'] = u"%d" % i
+        f.model()['did'] = dids[i % 2]
+        d.addNote(f)
+    d.db.execute("update cards set queue = 2, type = 2, ivl = 1, due = 0")
+    d.reset()
+    assert d.sched.counts() == (0,0,20)
+    seen = []
+    while True:
+        c = d.sched.getCard()
+        if not c:
+            break
+        seen.append(c.did)
+        d.sched.answerCard(c, 3)
+    assert len(seen) == 20
+    # both children are in the first few cards
+    assert set(seen[:6]) == set(dids)
+
+def test_interleavedPaging():
+    d = getEmptyDeck()
+    d.conf['interleaveDecks'] = True
+    d.sched.pageLimit = 10
+    conf = d.decks.confForDid(1)
+    conf['rev']['perDay'] = 20
+    d.decks.save(conf)
+    did = d.decks.id("Default::1")
+    for i in range(200):
+        f = d.newNote()
+        f['Front'] = u"%d" % i
+        f.model()['did'] = did
+        d.addNote(f)
+    d.db.execute("update cards set queue = 2, type = 2, ivl = 1, due = 0")
+    pages = []
+    orig = d.sched._mergePage
+    def mergePage(*args):
+        pages.append(args[2])
+        return orig(*args)
+    d.sched._mergePage = mergePage
+    d.reset()
+    seen = 0
+    while True:
+        c = d.sched.getCard()
+        if not c:
+            break
+        seen += 1
+        d.sched.answerCard(c, 3)
+    assert seen == 20
+    # once the parent's limit is hit, the child isn't paged any further
+    assert len(pages) <= 3
+
 def test_reorder():
     d = getEmptyDeck()
     # add a note with default deck
@@ -1124,3 +1442,27 @@ def test_norelearn():
     d.sched.answerCard(c, 1)
     d.sched._cardConf(c)['lapse']['delays'] = []
     d.sched.answerCard(c, 1)
+
+def test_simulateForecast():
+    d = getEmptyDeck()
+    for i in range(2):
+        f = d.newNote()
+        f['Front'] = u"%d" % i
+        d.addNote(f)
+    d.db.execute("update cards set type = 2, queue = 2, factor = 2500")
+    c1, c2 = [d.getCard(id) for id in d.db.list("select id from cards")]
+    c1.ivl = 1; c1.due = d.sched.today; c1.flush()
+    # two days late
+    c2.ivl = 4; c2.due = d.sched.today - 2; c2.flush()
+    d.sched.reset()
+    sims = [d.sched.simulateForecast]
+    def noArrays(days, passRates):
+        rows = d.db.all("select ivl, factor, due - ?, did from cards",
+                        d.sched.today)
+        return d.sched._simulateCards(rows, days, passRates, 0)
+    sims.append(noArrays)
+    for sim in sims:
+        # always passing: 1 -> 2 -> 5 days, and (4+1)*2.5 for the late one
+        assert sim(days=10, passRates=(1, 1)) == [2,0,1,0,0,0,0,1,0,0]
+        # always failing: back the next day
+        assert sim(days=10, passRates=(0, 0)) == [2]*10
@@ -1,6 +1,6 @@
 # coding: utf-8
 
-import nose, os, tempfile, shutil, time
+import nose, os, tempfile, shutil, time, threading
 from tests.shared import assertException
 
 from anki.errors import *
@@ -96,6 +96,94 @@ def test_sync():
     assert client.sync() == "success"
     assert deck1.crt == deck2.crt
 
+@nose.with_setup(setup_modified)
+def test_chunkSize():
+    for i in range(30):
+        f = deck1.newNote()
+        f['Front'] = u"%d" % i; f['Back'] = u"x"*200
+        deck1.addNote(f)
+    deck1.save()
+    # keep the chunk size fixed at 2000 bytes
+    client.chunkBytes = client.chunkMinBytes = client.chunkMaxBytes = 2000
+    sizes = []
+    orig = server.applyChunk
+    def applyChunk(chunk):
+        sizes.append(sum(client._rowBytes(chunk.get(t, []))
+                         for t in ("revlog", "cards", "notes")))
+        return orig(chunk=chunk)
+    server.applyChunk = applyChunk
+    assert client.sync() == "success"
+    assert deck2.noteCount() == 32
+    # the notes are split across several chunks near the limit
+    assert len(sizes) > 3
+    assert max(sizes) < 2000*2
+    # fast round trips grow the limit, slow ones shrink it
+    client.chunkMaxBytes = 8000
+    client.adaptChunk(0)
+    assert client.chunkBytes == 4000
+    client.adaptChunk(client.chunkTime + 1)
+    assert client.chunkBytes == 2000
+    client.adaptChunk(client.chunkTime + 1)
+    assert client.chunkBytes == 2000
+
+class _ThreadedServer(object):
+    "Serves prepared chunks and records received ones, from any thread."
+
+    def __init__(self, server):
+        self.server = server
+        self.threads = set()
+        self.received = []
+
+    def __getattr__(self, name):
+        return getattr(self.server, name)
+
+    def applyChanges(self, **kw):
+        ret = self.server.applyChanges(**kw)
+        # chunks are read from the server's collection up front
+        self.out = []
+        while 1:
+            self.out.append(self.server.chunk())
+            if self.out[-1]['done']:
+                return ret
+
+    def chunk(self):
+        self.threads.add(threading.current_thread())
+        return self.out.pop(0)
+
+    def applyChunk(self, chunk):
+        self.threads.add(threading.current_thread())
+        self.received.append(chunk)
+
+    def sanityCheck(self):
+        for chunk in self.received:
+            self.server.applyChunk(chunk=chunk)
+        return self.server.sanityCheck()
+
+@nose.with_setup(setup_modified)
+def test_pipelined():
+    for i in range(10):
+        f = deck1.newNote()
+        f['Front'] = u"%d" % i
+        deck1.addNote(f)
+    deck1.save()
+    client.chunkBytes = client.chunkMinBytes = client.chunkMaxBytes = 500
+    client.server = _ThreadedServer(server)
+    assert client.pipelined()
+    assert client.sync() == "success"
+    assert threading.current_thread() not in client.server.threads
+    assert len(client.server.received) > 1
+    assert deck1.noteCount() == deck2.noteCount() == 12
+    # errors in the worker are raised in the caller
+    def fail():
+        raise ZeroDivisionError
+    client.server.chunk = fail
+    deck1.setMod()
+    deck1.save()
+    assertException(ZeroDivisionError, client.sync)
+    # local servers aren't pipelined
+    client.server = server
+    assert not client.pipelined()
+
 @nose.with_setup(setup_modified)
 def test_models():
     test_sync()
@@ -262,3 +350,164 @@ def _test_speed():
     print "load %d" % ((time.time() - t)*1000); t = time.time()
     assert client.sync() == "success"
     print "sync %d" % ((time.time() - t)*1000); t = time.time()
+
+# Full sync over a local HTTP server
+##########################################################################
+
+import gzip, cgi
+from cStringIO import StringIO
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+import anki.sync
+from anki.sync import HttpSyncer, httpStats, resetHttp, syncFormats, \
+    dumps, loads
+from anki.utils import json
+
+class _HTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class _FullSyncHandler(BaseHTTPRequestHandler):
+
+    stored = None
+
+    def _data(self):
+        body = self.rfile.read(int(self.headers['content-length']))
+        form = cgi.FieldStorage(
+            fp=StringIO(body), headers=self.headers,
+            environ=dict(REQUEST_METHOD="POST"))
+        data = form['data'].value if 'data' in form else ""
+        if form.getvalue('c') == "1":
+            data = gzip.GzipFile(fileobj=StringIO(data)).read()
+        return form, data
+
+    def _send(self, out):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+    def do_POST(self):
+        form, data = self._data()
+        if self.path.endswith("/upload"):
+            _FullSyncHandler.stored = data
+            out = "OK"
+            enc = None
+        else:
+            buf = StringIO()
+            g = gzip.GzipFile(mode="wb", fileobj=buf)
+            g.write(_FullSyncHandler.stored)
+            g.close()
+            out = buf.getvalue()
+            enc = "gzip"
+        self.send_response(200)
+        if enc:
+            self.send_header("Content-Encoding", enc)
+        self.send_header("Content-Length", str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+    def log_message(self, *args):
+        pass
+
+class _KeepAliveHandler(_FullSyncHandler):
+    protocol_version = "HTTP/1.1"
+
+def _startServer(handler):
+    httpd = _HTTPServer(("127.0.0.1", 0), handler)
+    t = threading.Thread(target=httpd.serve_forever)
+    t.daemon = True
+    t.start()
+    anki.sync.SYNC_URL = "http://127.0.0.1:%d/sync/" % httpd.server_port
+    return httpd
+
+def test_streamingFullSync():
+    old = anki.sync.SYNC_URL
+    httpd = _startServer(_FullSyncHandler)
+    try:
+        deck = getEmptyDeck()
+        f = deck.newNote()
+        f['Front'] = u"streamed"
+        deck.addNote(f)
+        deck.save()
+        # a small spool forces the body to disk
+        anki.sync.HTTP_SPOOL = 1024
+        FullSyncer(deck, "key", None).upload()
+        assert _FullSyncHandler.stored == open(deck.path, "rb").read()
+        deck.close()
+        deck2 = getEmptyDeck()
+        path = deck2.path
+        FullSyncer(deck2, "key", None).download()
+        deck2 = aopen(path)
+        assert deck2.findNotes("streamed")
+        deck2.close()
+    finally:
+        anki.sync.SYNC_URL = old
+        anki.sync.HTTP_SPOOL = 1024*1024
+        httpd.shutdown()
+
+def test_connectionReuse():
+    old = anki.sync.SYNC_URL
+    httpd = _startServer(_KeepAliveHandler)
+    try:
+        resetHttp()
+        s1 = HttpSyncer("key")
+        s2 = RemoteMediaServer("key", None)
+        assert s1.con is s2.con
+        start = httpStats()
+        assert s1.req("upload", StringIO("one")) == "OK"
+        assert s2.req("upload", StringIO("two")) == "OK"
+        assert s1.req("download", comp=0) == "two"
+        st = httpStats()
+        assert st['requests'] - start['requests'] == 3
+        assert st['connections'] - start['connections'] == 1
+        # streamed requests keep their own connection alive too
+        assert s1.streamReq("upload", StringIO("three")) == "OK"
+        assert s2.streamReq("download") == "three"
+        st = httpStats()
+        assert st['requests'] - start['requests'] == 5
+        assert st['connections'] - start['connections'] == 2
+        # other threads get their own pool
+        cons = []
+        t = threading.Thread(target=lambda: cons.append(HttpSyncer().con))
+        t.start(); t.join()
+        assert cons[0] is not s1.con
+    finally:
+        resetHttp()
+        anki.sync.SYNC_URL = old
+        httpd.shutdown()
+
+class _MetaHandler(_KeepAliveHandler):
+
+    format = None
+
+    def do_POST(self):
+        form, data = self._data()
+        if self.path.endswith("/meta"):
+            assert json.loads(data)['f'] == syncFormats()
+            self._send(json.dumps([1, 2, 3, 4, 5, _MetaHandler.format]))
+        else:
+            # echo the payload back in the format it was sent in
+            assert (form.getvalue('f') or "json") == _MetaHandler.format
+            self._send(data)
+
+def test_formats():
+    data = dict(cards=[[1, u"a\u3042", None, 2.5]], done=True)
+    assert syncFormats()[-1] == "json"
+    for fmt in syncFormats():
+        assert loads(dumps(data, fmt), fmt) == data
+    old = anki.sync.SYNC_URL
+    httpd = _startServer(_MetaHandler)
+    try:
+        # servers that don't choose a format get json
+        for fmt in ("json", "unknown") + tuple(syncFormats()):
+            _MetaHandler.format = fmt
+            rs = RemoteServer("key")
+            assert rs.meta() == [1, 2, 3, 4, 5]
+            if fmt == "unknown":
+                _MetaHandler.format = "json"
+            assert rs.fmt == _MetaHandler.format
+            assert rs.chunk(**data) == data
+    finally:
+        resetHttp()
+        anki.sync.SYNC_URL = old
+        httpd.shutdown()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright: Damien Elmes <anki@ichi2.net>
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+#
+# Compare sync payload formats on the chunks of a collection.
+#
+# usage: tools/syncbench.py [collection.anki2]
+#
+# Without a collection, a temporary one with generated notes and reviews is
+# used. The collection is opened read only in spirit: chunks are read the way
+# a server reads them, so no usns are changed.
+
+import os, sys, time, tempfile, shutil, zlib, random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from anki import Collection
+from anki.sync import Syncer, syncFormats, dumps, loads
+
+def sampleCol(path, notes=5000):
+    col = Collection(path)
+    random.seed(0)
+    for i in range(notes):
+        f = col.newNote()
+        f['Front'] = u"front %d %s" % (i, u"x" * random.randint(5, 50))
+        f['Back'] = u"back <b>%d</b> %s" % (i, u"y" * random.randint(5, 500))
+        col.addNote(f)
+    col.db.executemany(
+        "insert into revlog values (?,?,?,?,?,?,?,?,?)",
+        [(1000000000000+i, 1, -1, 3, 10, 1, 2500, 8000, 1)
+         for i in range(notes*5)])
+    col.save()
+    return col
+
+def chunks(col):
+    "All the chunks a server would send for COL."
+    s = Syncer(col)
+    server = col.server
+    col.server = True
+    try:
+        # include unsent rows too
+        s.minUsn = -1
+        s.maxUsn = col._usn
+        s.prepareToChunk()
+        out = []
+        while 1:
+            out.append(s.chunk())
+            if out[-1]['done']:
+                return out
+    finally:
+        col.server = server
+
+def bench(chunks, fmt):
+    t = time.time()
+    data = [dumps(c, fmt) for c in chunks]
+    enc = time.time() - t
+    t = time.time()
+    for d in data:
+        loads(d, fmt)
+    dec = time.time() - t
+    raw = sum(len(d) for d in data)
+    comp = sum(len(zlib.compress(d, 6)) for d in data)
+    return enc, dec, raw, comp
+
+def main():
+    tmp = None
+    if len(sys.argv) > 1:
+        col = Collection(os.path.abspath(sys.argv[1]), lock=False)
+    else:
+        tmp = tempfile.mkdtemp()
+        col = sampleCol(os.path.join(tmp, u"bench.anki2"))
+    try:
+        cs = chunks(col)
+        rows = sum(len(c.get(t, [])) for c in cs
+                   for t in ("revlog", "cards", "notes"))
+        print "%d chunks, %d rows" % (len(cs), rows)
+        print "%-8s %10s %10s %12s %12s" % (
+            "format", "encode ms", "decode ms", "bytes", "gzip bytes")
+        for fmt in syncFormats():
+            enc, dec, raw, comp = bench(cs, fmt)
+            print "%-8s %10d %10d %12d %12d" % (
+                fmt, enc*1000, dec*1000, raw, comp)
+        if len(syncFormats()) == 1:
+            print "msgpack is not installed; only json was measured"
+    finally:
+        col.close(save=False)
+        if tmp:
+            shutil.rmtree(tmp)
+
+if __name__ == "__main__":
+    main()